@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+"""Drive a receiver with thousands of simulated agents and dashboards.
+
+Every virtual sender posts a synthetic get_sysstat() payload once per
+interval, over HTTP /data (stdlib keep-alive client) or as socket json_data
+events (python-socketio[asyncio_client]). Dashboards subscribe to the
+receiver's 'updates' stream to measure broadcast fan-out latency. Results
+are written as JSON so runs can be compared for regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import time
+from urllib.parse import urlparse
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(ROOT, 'receiver'))
+
+from timeseries import percentile
+
+
+def make_payload(device_id, rng, n_ifaces=2, n_disks=2):
+    """Synthetic payload in the same shape as sender.get_sysstat()"""
+    total = 16 * 1024 * 1024
+    used = int(total * rng.uniform(0.1, 0.9))
+    return {
+        "id": device_id,
+        "timestamp": int(time.time()),
+        "cpu_usage_percent": rng.uniform(0, 100),
+        "memory": {
+            "kbmemfree": str(total - used),
+            "kbmemused": str(used),
+            "memused_percent": f"{used * 100.0 / total:.2f}"
+        },
+        "network": [
+            {'iface': f"eth{i}", 'rx_kb': f"{rng.uniform(0, 5000):.2f}",
+             'tx_kb': f"{rng.uniform(0, 5000):.2f}"}
+            for i in range(n_ifaces)
+        ],
+        "disk": [
+            {'device': f"sd{chr(ord('a') + i)}", 'wait': rng.uniform(0, 20),
+             'util': rng.uniform(0, 100)}
+            for i in range(n_disks)
+        ]
+    }
+
+
+def latency_summary(seconds):
+    if not seconds:
+        return {'count': 0}
+    return {
+        'count': len(seconds),
+        'p50_ms': percentile(seconds, 50) * 1000,
+        'p99_ms': percentile(seconds, 99) * 1000,
+        'max_ms': max(seconds) * 1000
+    }
+
+
+class Stats:
+    def __init__(self):
+        self.sent = 0
+        self.errors = 0
+        self.ack = []
+        self.fanout = []
+        self.rss = []
+
+
+class HttpConnection:
+    """Minimal HTTP/1.1 keep-alive client, enough for POST /data"""
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = self.writer = None
+
+    async def post(self, path, body):
+        if self.writer is None:
+            self.reader, self.writer = await asyncio.open_connection(
+                self.host, self.port)
+        self.writer.write(
+            f"POST {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+        await self.writer.drain()
+        status = int((await self.reader.readline()).split()[1])
+        length = 0
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode().partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        await self.reader.readexactly(length)
+        return status
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+async def http_sender(index, args, stats, stop_at):
+    url = urlparse(args.url)
+    conn = HttpConnection(url.hostname, url.port or 80)
+    rng = random.Random(index)
+    device_id = f"sim-{index:05d}"
+    next_send = time.monotonic() + rng.uniform(0, args.interval)
+    try:
+        while next_send < stop_at:
+            await asyncio.sleep(max(0, next_send - time.monotonic()))
+            payload = make_payload(device_id, rng)
+            payload['bench_sent'] = time.time()
+            start = time.perf_counter()
+            try:
+                status = await conn.post('/data', json.dumps(payload).encode())
+                if status >= 400:
+                    raise OSError(f"HTTP {status}")
+                stats.ack.append(time.perf_counter() - start)
+                stats.sent += 1
+            except (OSError, ValueError, IndexError, asyncio.IncompleteReadError):
+                stats.errors += 1
+                conn.close()
+            next_send += args.interval
+    finally:
+        conn.close()
+
+
+def socketio_module():
+    try:
+        import socketio
+    except ImportError:
+        print("socketio mode and dashboards need python-socketio[asyncio_client]",
+              file=sys.stderr)
+        sys.exit(1)
+    return socketio
+
+
+async def socketio_sender(index, args, stats, stop_at):
+    socketio = socketio_module()
+    client = socketio.AsyncClient(reconnection=False)
+    rng = random.Random(index)
+    device_id = f"sim-{index:05d}"
+    await asyncio.sleep(rng.uniform(0, args.interval))
+    try:
+        await client.connect(args.url, transports=['websocket'])
+    except socketio.exceptions.ConnectionError:
+        stats.errors += 1
+        return
+    next_send = time.monotonic()
+    try:
+        while next_send < stop_at:
+            await asyncio.sleep(max(0, next_send - time.monotonic()))
+            payload = make_payload(device_id, rng)
+            payload['bench_sent'] = time.time()
+            start = time.perf_counter()
+            try:
+                await client.call('json_data', payload, timeout=10)
+                stats.ack.append(time.perf_counter() - start)
+                stats.sent += 1
+            except socketio.exceptions.SocketIOError:
+                stats.errors += 1
+            next_send += args.interval
+    finally:
+        await client.disconnect()
+
+
+async def dashboard(args, stats, stop_at):
+    socketio = socketio_module()
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on('updates')
+    async def on_updates(batch):
+        now = time.time()
+        for section in ('full', 'delta'):
+            for data in (batch.get(section) or {}).values():
+                if 'bench_sent' in data:
+                    stats.fanout.append(now - data['bench_sent'])
+        return True
+
+    await client.connect(args.url, transports=['websocket'])
+    await asyncio.sleep(max(0, stop_at - time.monotonic()))
+    await client.disconnect()
+
+
+def read_rss_kb(pid):
+    try:
+        with open(f"/proc/{pid}/status", 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except FileNotFoundError:
+        pass
+    return None
+
+
+async def sample_rss(pid, stats, stop_at, start):
+    while time.monotonic() < stop_at:
+        rss = read_rss_kb(pid)
+        if rss is not None:
+            stats.rss.append([round(time.monotonic() - start, 1), rss])
+        await asyncio.sleep(1)
+
+
+async def run(args):
+    stats = Stats()
+    start = time.monotonic()
+    stop_at = start + args.duration
+    sender = socketio_sender if args.mode == 'socketio' else http_sender
+    tasks = [dashboard(args, stats, stop_at) for _ in range(args.dashboards)]
+    tasks += [sender(i, args, stats, stop_at) for i in range(args.senders)]
+    if args.receiver_pid:
+        tasks.append(sample_rss(args.receiver_pid, stats, stop_at, start))
+    await asyncio.gather(*tasks)
+    elapsed = time.monotonic() - start
+
+    return {
+        'config': {
+            'url': args.url, 'mode': args.mode, 'senders': args.senders,
+            'interval': args.interval, 'duration': args.duration,
+            'dashboards': args.dashboards
+        },
+        'ingest': {
+            'sent': stats.sent,
+            'errors': stats.errors,
+            'per_second': stats.sent / elapsed
+        },
+        'ack_latency': latency_summary(stats.ack),
+        'fanout_latency': latency_summary(stats.fanout),
+        'rss_kb': stats.rss,
+        'rss_peak_kb': max((kb for _, kb in stats.rss), default=None)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Simulate a fleet of agents against a receiver',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-u', '--url', default='http://localhost:8000',
+                        help='Receiver URL')
+    parser.add_argument('-m', '--mode', choices=['http', 'socketio'],
+                        default='http', help='How senders deliver samples')
+    parser.add_argument('-n', '--senders', type=int, default=1000,
+                        help='Number of simulated agents')
+    parser.add_argument('-i', '--interval', type=float, default=5,
+                        help='Seconds between samples per agent')
+    parser.add_argument('-t', '--duration', type=float, default=30,
+                        help='Length of the run in seconds')
+    parser.add_argument('-k', '--dashboards', type=int, default=0,
+                        help='Number of simulated dashboard clients')
+    parser.add_argument('-p', '--receiver-pid', type=int,
+                        help='Sample this process\'s RSS once a second')
+    parser.add_argument('-o', '--output',
+                        help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the sender's collection/encoding and the monitor's
+rendering, reported as JSON (mean microseconds per call)."""
+import argparse
+import io
+import json
+import os
+import random
+import sys
+import time
+from contextlib import redirect_stdout
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'sender'), os.path.join(ROOT, 'eecs')]
+
+import sender
+import monitor
+from fleet_sim import make_payload
+
+
+def measure(fn, min_time=0.5):
+    """Mean seconds per call, repeating until min_time has elapsed"""
+    fn()  # warm up
+    calls = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        calls += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            return elapsed / calls
+
+
+def history_rows(payloads):
+    """Rows as the Node server's /data/:id returns them"""
+    return [dict(device_id=p['id'], timestamp=p['timestamp'],
+                 cpu_usage_percent=p['cpu_usage_percent'],
+                 network=p['network'], disk=p['disk'], **p['memory'])
+            for p in payloads]
+
+
+def benchmarks(rng):
+    payload = make_payload('bench', rng)
+    payloads = [make_payload(f"dev-{i}", rng) for i in range(500)]
+    rows = history_rows(payloads[:100])
+    cases = {}
+
+    if sender.ProcCollector.available():
+        collector = sender.ProcCollector(warmup=0)
+        cases['sender.proc_collect'] = lambda: collector.collect('bench')
+
+    window = sender.SampleWindow(20, 0.25)
+    for p in payloads[:20]:
+        window.add(p)
+    cases['sender.window_add'] = lambda: window.add(payload)
+    cases['sender.window_summarize'] = window.summarize
+    cases['sender.json_encode'] = lambda: json.dumps(payload,
+                                                     separators=(',', ':'))
+    try:
+        encoder = sender.CompactEncoder()
+        cases['sender.compact_encode'] = lambda: encoder.encode(payload)
+    except SystemExit:
+        pass  # msgpack not installed
+
+    def print_stats():
+        with redirect_stdout(io.StringIO()):
+            monitor.print_stats(rows, verbose=True)
+    cases['monitor.print_stats'] = print_stats
+
+    def watch_full_redraw():
+        view = monitor.WatchView(min_interval=0, out=io.StringIO())
+        for p in payloads:
+            view.update(p['id'], p)
+        view.render(force=True)
+    cases['monitor.watch_full_redraw_500'] = watch_full_redraw
+
+    view = monitor.WatchView(min_interval=0, out=io.StringIO())
+    for p in payloads:
+        view.update(p['id'], p)
+    view.render(force=True)
+
+    def watch_incremental():
+        for p in payloads[:10]:
+            p['cpu_usage_percent'] = rng.uniform(0, 100)
+            view.update(p['id'], p)
+        view.render()
+    cases['monitor.watch_incremental_10_of_500'] = watch_incremental
+    return cases
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run sender/monitor microbenchmarks',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('-t', '--min-time', type=float, default=0.5,
+                        help='Seconds to spend on each benchmark')
+    parser.add_argument('-o', '--output',
+                        help='Write the JSON results here instead of stdout')
+    args = parser.parse_args()
+
+    results = {name: {'us_per_call': measure(fn, args.min_time) * 1e6}
+               for name, fn in benchmarks(random.Random(0)).items()}
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+
+if __name__ == '__main__':
+    main()
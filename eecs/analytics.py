@@ -0,0 +1,227 @@
+"""Offline fleet analytics straight from a device_stats SQLite database.
+
+Used by monitor.py --db. Rows are read in chunks, the network_data and
+disk_data JSON is exploded once into columnar NumPy arrays, and all
+grouping, percentiles, rankings and threshold scans are vectorized.
+"""
+import csv
+import json
+import sqlite3
+import sys
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    print("Analytics mode needs the numpy package", file=sys.stderr)
+    sys.exit(1)
+
+def open_readonly(path):
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+class Codes:
+    """Map strings (device ids, interface and disk names) to small ints"""
+
+    def __init__(self):
+        self.index = {}
+        self.names = []
+
+    def __call__(self, name):
+        code = self.index.get(name)
+        if code is None:
+            code = self.index[name] = len(self.names)
+            self.names.append(name)
+        return code
+
+def to_floats(values):
+    """float64 array from numbers or numeric strings; bad values become NaN"""
+    try:
+        return np.array(values, dtype=np.float64)
+    except (TypeError, ValueError):
+        out = np.empty(len(values))
+        for i, value in enumerate(values):
+            try:
+                out[i] = float(value)
+            except (TypeError, ValueError):
+                out[i] = np.nan
+        return out
+
+def explode(device_codes, documents, names, name_field, fields):
+    """Explode a chunk of JSON list columns into flat columnar arrays.
+
+    The whole chunk is parsed with a single json.loads call, and each
+    element inherits the device code of its row via np.repeat.
+    """
+    parsed = json.loads('[' + ','.join(d or '[]' for d in documents) + ']')
+    lengths = np.fromiter(map(len, parsed), dtype=np.int64, count=len(parsed))
+    flat = [item for items in parsed for item in items]
+    columns = {
+        'device': np.repeat(device_codes, lengths),
+        'name': np.fromiter((names(item.get(name_field)) for item in flat),
+                            dtype=np.int64, count=len(flat))
+    }
+    for field in fields:
+        columns[field] = to_floats([item.get(field) for item in flat])
+    return columns
+
+def load_fleet(conn, since, kind, chunk_size=100000):
+    """Load the columns a report needs for rows newer than since.
+
+    Returns {'columns': {name: array}, 'devices': Codes, 'names': Codes}.
+    'cpu' and 'memory' give device/cpu/memory columns straight from the
+    table; 'disk' and 'network' explode disk_data or network_data into
+    device/name/<field> columns, one row per disk or interface sample.
+    """
+    devices, names = Codes(), Codes()
+    json_column = {'disk': 'disk_data', 'network': 'network_data'}.get(kind)
+    cursor = conn.execute(f"""
+        SELECT device_id, cpu_usage_percent, CAST(memused_percent AS REAL)
+               {', ' + json_column if json_column else ''}
+        FROM device_stats WHERE timestamp >= ?
+    """, (since,))
+
+    parts = []
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        columns = list(zip(*rows))
+        codes = np.fromiter(map(devices, columns[0]), dtype=np.int64,
+                            count=len(rows))
+        if kind == 'disk':
+            parts.append(explode(codes, columns[3], names, 'device',
+                                 ('wait', 'util')))
+        elif kind == 'network':
+            parts.append(explode(codes, columns[3], names, 'iface',
+                                 ('rx_kb', 'tx_kb')))
+        else:
+            parts.append({'device': codes,
+                          'cpu': to_floats(columns[1]),
+                          'memory': to_floats(columns[2])})
+
+    columns = {}
+    if parts:
+        columns = {key: np.concatenate([part[key] for part in parts])
+                   for key in parts[0]}
+    return {'columns': columns, 'devices': devices, 'names': names}
+
+def grouped_stats(groups, values, pct):
+    """Per-group count, mean, max and nearest-rank percentile.
+
+    groups is an int array of group keys; NaN values are ignored. Done
+    with one lexsort, so there is no Python loop over groups.
+    """
+    keep = ~np.isnan(values)
+    groups, values = groups[keep], values[keep]
+    if not len(values):
+        empty = np.empty(0)
+        return np.empty(0, dtype=np.int64), empty, empty, empty, empty
+    order = np.lexsort((values, groups))
+    groups, values = groups[order], values[order]
+    keys, starts, counts = np.unique(groups, return_index=True,
+                                     return_counts=True)
+    rank = np.maximum(np.ceil(pct / 100.0 * counts).astype(np.int64) - 1, 0)
+    percentile = values[starts + rank]
+    maximum = values[starts + counts - 1]
+    mean = np.add.reduceat(values, starts) / counts
+    return keys, counts, mean, maximum, percentile
+
+def pair_key(a, b, width):
+    return a * width + b
+
+def align(keys, other_keys, other_values):
+    """Reorder other_values (keyed by other_keys) to line up with keys"""
+    aligned = np.full(len(keys), np.nan)
+    if len(keys) and len(other_keys):
+        idx = np.minimum(np.searchsorted(keys, other_keys), len(keys) - 1)
+        match = keys[idx] == other_keys
+        aligned[idx[match]] = other_values[match]
+    return aligned
+
+def report(fleet, kind, pct=95, top=20, threshold=90.0):
+    """Build a report as a list of row dicts, already ranked"""
+    devices = fleet['devices'].names
+    names = fleet['names'].names
+    label = f"p{pct:g}"
+
+    c = fleet['columns']
+    if not c:
+        return []
+    if kind in ('cpu', 'memory'):
+        keys, counts, mean, maximum, p = grouped_stats(c['device'], c[kind], pct)
+        order = np.argsort(-p)[:top]
+        return [{'device': devices[keys[i]], 'samples': int(counts[i]),
+                 'mean': round(float(mean[i]), 2), label: round(float(p[i]), 2),
+                 'max': round(float(maximum[i]), 2)} for i in order]
+
+    width = max(len(names), 1)
+    key = pair_key(c['device'], c['name'], width)
+    if kind == 'disk':
+        keys, counts, _, max_util, p_util = grouped_stats(key, c['util'], pct)
+        wait_keys, _, _, _, p_wait = grouped_stats(key, c['wait'], pct)
+        p_wait = align(keys, wait_keys, p_wait)
+        over = c['util'] > threshold
+        over_keys, over_counts = np.unique(key[over], return_counts=True)
+        over_by_key = np.zeros(len(keys), dtype=np.int64)
+        over_by_key[np.searchsorted(keys, over_keys)] = over_counts
+        hits = np.nonzero(over_by_key)[0]
+        order = hits[np.lexsort((-max_util[hits], -over_by_key[hits]))][:top]
+        return [{'device': devices[keys[i] // width],
+                 'disk': names[keys[i] % width], 'samples': int(counts[i]),
+                 f'over_{threshold:g}': int(over_by_key[i]),
+                 'max_util': round(float(max_util[i]), 2),
+                 f'{label}_util': round(float(p_util[i]), 2),
+                 f'{label}_wait': round(float(p_wait[i]), 2)} for i in order]
+
+    keys, counts, _, _, p_rx = grouped_stats(key, c['rx_kb'], pct)
+    tx_keys, _, _, _, p_tx = grouped_stats(key, c['tx_kb'], pct)
+    p_tx = align(keys, tx_keys, p_tx)
+    order = np.argsort(-(p_rx + np.nan_to_num(p_tx)))[:top]
+    return [{'device': devices[keys[i] // width],
+             'iface': names[keys[i] % width], 'samples': int(counts[i]),
+             f'{label}_rx_kb': round(float(p_rx[i]), 2),
+             f'{label}_tx_kb': round(float(p_tx[i]), 2)} for i in order]
+
+def print_report(rows):
+    if not rows:
+        print("No matching data")
+        return
+    columns = list(rows[0])
+    widths = [max(len(c), *(len(str(r[c])) for r in rows)) for c in columns]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    print("  ".join("-" * w for w in widths))
+    for row in rows:
+        print("  ".join(str(row[c]).ljust(w) for c, w in zip(columns, widths)))
+
+def export(rows, path):
+    """Write rows to CSV, or to Parquet when path ends in .parquet"""
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            print("Parquet export needs the pyarrow package", file=sys.stderr)
+            sys.exit(1)
+        columns = {c: [r[c] for r in rows] for c in (rows[0] if rows else [])}
+        pyarrow.parquet.write_table(pyarrow.table(columns), path)
+        return
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else [])
+        writer.writeheader()
+        writer.writerows(rows)
+
+def run(db_path, kind, hours, pct=95, top=20, threshold=90.0,
+        export_path=None):
+    conn = open_readonly(db_path)
+    try:
+        fleet = load_fleet(conn, int(time.time() - hours * 3600), kind)
+    except sqlite3.Error as e:
+        print(f"Error reading {db_path}: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        conn.close()
+    rows = report(fleet, kind, pct, top, threshold)
+    print_report(rows)
+    if export_path:
+        export(rows, export_path)
+        print(f"\nWrote {len(rows)} rows to {export_path}")
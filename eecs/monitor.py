@@ -1,31 +1,86 @@
 #!/usr/bin/env python3
 import requests
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import json
+import shutil
 import textwrap
+import threading
+import time
 import sys
 
-def get_all_devices(server_url):
+def make_session(workers):
+    """Keep-alive session with a connection pool sized for the workers"""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def get_all_devices(server_url, session=requests, timeout=10):
     try:
-        response = requests.get(f"{server_url}/devices")
+        response = session.get(f"{server_url}/devices", timeout=timeout)
         response.raise_for_status()
         return response.json()
     except requests.exceptions.RequestException as e:
         print(f"Error fetching devices: {e}", file=sys.stderr)
         sys.exit(1)
 
-def get_device_stats(server_url, device_id, hours=24):
-    try:
-        response = requests.get(
-            f"{server_url}/data/{device_id}",
-            params={'limit': 100, 'hours': hours}
-        )
-        response.raise_for_status()
-        # print(response.json())
-        return response.json()
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching stats for device {device_id}: {e}", file=sys.stderr)
-        sys.exit(1)
+def get_device_stats(server_url, device_id, hours=24, session=requests,
+                     timeout=10):
+    response = session.get(
+        f"{server_url}/data/{device_id}",
+        params={'limit': 100, 'hours': hours},
+        timeout=timeout
+    )
+    response.raise_for_status()
+    return response.json()
+
+def get_fleet_stats(server_url, device_ids, hours=24, limit=100,
+                    session=requests, timeout=30):
+    """Fetch stats for many devices in one request via /devices/stats"""
+    params = {'limit': limit, 'hours': hours}
+    if device_ids:
+        params['ids'] = ','.join(device_ids)
+    response = session.get(f"{server_url}/devices/stats", params=params,
+                           timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+def fetch_all_stats(server_url, device_ids, hours=24, workers=8, timeout=10,
+                    session=requests):
+    """Fetch stats for every device concurrently.
+
+    Returns (results, failures), both dicts keyed by device id. A device
+    that times out or errors is reported in failures instead of stopping
+    the whole run.
+    """
+    results, failures = {}, {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            device_id: pool.submit(get_device_stats, server_url, device_id,
+                                   hours, session, timeout)
+            for device_id in device_ids
+        }
+        for device_id, future in futures.items():
+            try:
+                results[device_id] = future.result()
+            except (requests.exceptions.RequestException, ValueError) as e:
+                failures[device_id] = e
+    return results, failures
+
+def get_device_history(server_url, device_id, hours=24, step=None,
+                       stat='avg', session=requests, timeout=10):
+    """Rollup history from receiver.py's /api/device/<id>/history"""
+    params = {'hours': hours, 'stat': stat}
+    if step is not None:
+        params['step'] = step
+    response = session.get(f"{server_url}/api/device/{device_id}/history",
+                           params=params, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
 
 def format_timestamp(ts):
     return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
@@ -77,6 +132,194 @@ def print_stats(stats, verbose=False):
                   f"{net_stats:>15}  "
                   f"{disk_stats:>15}")
 
+def print_history(device_id, history):
+    """One line per point: CPU and memory, summed network, busiest disk"""
+    timestamps = history.get('timestamps') or []
+    if not timestamps:
+        print("No history available for this device/time range")
+        return
+
+    def total(columns, i):
+        values = [column[i] for column in columns if column[i] is not None]
+        return sum(values) if values else None
+
+    def cell(value, width):
+        return f"{'-':>{width}}" if value is None else f"{value:>{width}.1f}"
+
+    resolution = history.get('resolution') or 0
+    summary = (f"{resolution}s {history.get('stat')}" if resolution
+               else 'raw samples')
+    print(f"\n Device: {device_id} ({summary})")
+    print(f"{'Time':<19}  {'CPU%':>6}  {'MEM%':>6}  {'RX KB/s':>9}  "
+          f"{'TX KB/s':>9}  {'DISK%':>6}")
+    network = history.get('network') or {}
+    rx = [iface['rx'] for iface in network.values() if 'rx' in iface]
+    tx = [iface['tx'] for iface in network.values() if 'tx' in iface]
+    util = [disk['util'] for disk in (history.get('disk') or {}).values()
+            if 'util' in disk]
+    for i, ts in enumerate(timestamps):
+        busiest = [column[i] for column in util if column[i] is not None]
+        print(f"{format_timestamp(ts):<19}  "
+              f"{cell(history['cpu'][i], 6)}  "
+              f"{cell(history['memory'][i], 6)}  "
+              f"{cell(total(rx, i), 9)}  {cell(total(tx, i), 9)}  "
+              f"{cell(max(busiest) if busiest else None, 6)}")
+
+def to_float(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+class WatchView:
+    """Top-like terminal table of the latest state of every device.
+
+    update() only records changes; render() is rate-limited and rewrites
+    just the rows whose text changed, falling back to a full redraw when
+    devices appear or the terminal is resized.
+    """
+
+    HEADER = (f"{'DEVICE':<36}  {'CPU%':>6}  {'MEM%':>6}  {'RX KB/s':>9}  "
+              f"{'TX KB/s':>9}  {'DISK%':>6}  {'UPDATED':>8}")
+
+    def __init__(self, min_interval=0.5, out=sys.stdout):
+        self.min_interval = min_interval
+        self.out = out
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._dirty = set()
+        self._order = []
+        self._drawn_size = None
+        self._last_render = 0.0
+
+    @staticmethod
+    def format_row(device_id, data):
+        memory = data.get('memory') or {}
+        rx = sum(to_float(i.get('rx_kb')) for i in data.get('network', []))
+        tx = sum(to_float(i.get('tx_kb')) for i in data.get('network', []))
+        disk = max((to_float(d.get('util')) for d in data.get('disk', [])),
+                   default=0.0)
+        updated = datetime.fromtimestamp(
+            to_float(data.get('timestamp'))).strftime('%H:%M:%S')
+        return (f"{str(device_id)[:36]:<36}  "
+                f"{to_float(data.get('cpu_usage_percent')):>6.1f}  "
+                f"{to_float(memory.get('memused_percent')):>6.1f}  "
+                f"{rx:>9.2f}  {tx:>9.2f}  {disk:>6.1f}  {updated:>8}")
+
+    def update(self, device_id, data):
+        if not isinstance(data, dict):
+            return
+        row = self.format_row(device_id, data)
+        with self._lock:
+            if self._rows.get(device_id) != row:
+                self._rows[device_id] = row
+                self._dirty.add(device_id)
+
+    def render(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._last_render < self.min_interval:
+            return
+        size = shutil.get_terminal_size()
+        with self._lock:
+            if not self._dirty and not force and size == self._drawn_size:
+                return
+            self._last_render = now
+            visible = size.lines - 3
+            out = []
+            if (force or size != self._drawn_size
+                    or any(d not in self._order for d in self._dirty)):
+                self._order = sorted(self._rows)
+                out.append("\033[H\033[2J")
+                out.append(f"{len(self._rows)} devices, "
+                           f"updated {datetime.now():%H:%M:%S}\n")
+                out.append(self.HEADER + "\n")
+                for device_id in self._order[:visible]:
+                    out.append(self._rows[device_id] + "\n")
+                self._drawn_size = size
+            else:
+                out.append(f"\033[1;1H\033[2K{len(self._rows)} devices, "
+                           f"updated {datetime.now():%H:%M:%S}")
+                for device_id in self._dirty:
+                    line = self._order.index(device_id)
+                    if line < visible:
+                        out.append(f"\033[{line + 3};1H\033[2K"
+                                   f"{self._rows[device_id]}")
+                out.append(f"\033[{min(len(self._order), visible) + 3};1H")
+            self._dirty.clear()
+        self.out.write(''.join(out))
+        self.out.flush()
+
+def subscribe_ws(server_url, view):
+    """Follow device_update messages pushed by the Node server"""
+    try:
+        import websocket
+    except ImportError:
+        print("--watch needs the websocket-client package", file=sys.stderr)
+        sys.exit(1)
+
+    def on_message(ws, message):
+        try:
+            update = json.loads(message)
+        except ValueError:
+            return
+        if update.get('type') == 'device_update':
+            view.update(update.get('id'), update.get('data'))
+
+    url = 'ws' + server_url[len('http'):] \
+        if server_url.startswith('http') else server_url
+    app = websocket.WebSocketApp(url, on_message=on_message)
+    thread = threading.Thread(target=app.run_forever,
+                              kwargs={'reconnect': 5}, daemon=True)
+    thread.start()
+    return app.close
+
+def subscribe_socketio(server_url, view):
+    """Follow batched updates events pushed by receiver.py"""
+    try:
+        import socketio
+    except ImportError:
+        print("--watch-protocol socketio needs the python-socketio package",
+              file=sys.stderr)
+        sys.exit(1)
+
+    client = socketio.Client(reconnection=True)
+
+    state = {}
+
+    @client.on('updates')
+    def on_updates(batch):
+        if isinstance(batch, dict):
+            for device_id, data in (batch.get('full') or {}).items():
+                state[device_id] = data
+                view.update(device_id, data)
+            for device_id, fields in (batch.get('delta') or {}).items():
+                state[device_id] = dict(state.get(device_id, {}), **fields)
+                view.update(device_id, state[device_id])
+        return True  # acknowledge so the server sends the next batch
+
+    try:
+        client.connect(server_url, transports=['websocket'])
+    except socketio.exceptions.ConnectionError as e:
+        print(f"Error connecting to {server_url}: {e}", file=sys.stderr)
+        sys.exit(1)
+    return client.disconnect
+
+def watch(server_url, protocol='ws', refresh=0.5):
+    view = WatchView(min_interval=refresh)
+    subscribe = subscribe_socketio if protocol == 'socketio' else subscribe_ws
+    close = subscribe(server_url, view)
+    sys.stdout.write("\033[?25l")  # hide cursor
+    try:
+        view.render(force=True)
+        while True:
+            time.sleep(refresh)
+            view.render()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sys.stdout.write("\033[?25h\n")
+        close()
+
 def main():
     parser = argparse.ArgumentParser(
         description='Fetch and display device statistics from monitoring server',
@@ -107,24 +350,158 @@ def main():
         action='store_true',
         help='List all available devices and exit'
     )
+    parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=8,
+        help='Number of devices to fetch concurrently'
+    )
+    parser.add_argument(
+        '--timeout',
+        type=float,
+        default=10,
+        help='Per-request timeout in seconds'
+    )
+    parser.add_argument(
+        '-b', '--bulk',
+        action='store_true',
+        help='Fetch the whole fleet in a single server request'
+    )
+    parser.add_argument(
+        '-W', '--watch',
+        action='store_true',
+        help='Show a live table of all devices from the server push stream'
+    )
+    parser.add_argument(
+        '--watch-protocol',
+        choices=['ws', 'socketio'],
+        default='ws',
+        help='ws for the Node server, socketio for receiver.py'
+    )
+    parser.add_argument(
+        '--db',
+        help='Analyze a device_stats SQLite database directly (read-only) '
+             'instead of querying the server'
+    )
+    parser.add_argument(
+        '-r', '--report',
+        choices=['cpu', 'memory', 'disk', 'network'],
+        default='cpu',
+        help='Analytics report: top hosts by CPU/memory percentile, disks '
+             'over the util threshold, or busiest interfaces'
+    )
+    parser.add_argument(
+        '-p', '--percentile',
+        type=float,
+        default=95,
+        help='Percentile used to rank hosts in analytics reports'
+    )
+    parser.add_argument(
+        '-n', '--top',
+        type=int,
+        default=20,
+        help='Number of rows in analytics reports'
+    )
+    parser.add_argument(
+        '--threshold',
+        type=float,
+        default=90,
+        help='Disk %%util threshold for the disk report'
+    )
+    parser.add_argument(
+        '-o', '--export',
+        help='Write the analytics report to a .csv or .parquet file'
+    )
+    parser.add_argument(
+        '-H', '--history',
+        action='store_true',
+        help='Show long-range history of --device from the rollup tiers of '
+             'receiver.py instead of raw samples'
+    )
+    parser.add_argument(
+        '--step',
+        type=float,
+        help='Seconds per history point; by default about 500 points '
+             'cover --hours'
+    )
+    parser.add_argument(
+        '--stat',
+        choices=['avg', 'min', 'max', 'last'],
+        default='avg',
+        help='How history points summarize their interval'
+    )
+    parser.add_argument(
+        '--refresh',
+        type=float,
+        default=0.5,
+        help='Minimum seconds between redraws in watch mode'
+    )
     
     args = parser.parse_args()
 
+    if args.db:
+        import analytics
+        analytics.run(args.db, args.report, args.hours, args.percentile,
+                      args.top, args.threshold, args.export)
+        return
+
+    if args.watch:
+        watch(args.server, args.watch_protocol, args.refresh)
+        return
+
+    session = make_session(args.workers)
+
+    if args.history:
+        if not args.device:
+            parser.error("--history needs --device")
+        try:
+            history = get_device_history(args.server, args.device,
+                                         args.hours, args.step, args.stat,
+                                         session, args.timeout)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error fetching history: {e}", file=sys.stderr)
+            sys.exit(1)
+        print_history(args.device, history)
+        return
+
     if args.list:
-        devices = get_all_devices(args.server)
+        devices = get_all_devices(args.server, session, args.timeout)
         print("Available devices:")
         for device in devices:
             print(f"  - {device}")
         return
 
+    if args.bulk:
+        try:
+            fleet = get_fleet_stats(args.server,
+                                    [args.device] if args.device else [],
+                                    args.hours, session=session,
+                                    timeout=args.timeout)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Error fetching fleet stats: {e}", file=sys.stderr)
+            sys.exit(1)
+        for device_id in sorted(fleet):
+            print_stats(fleet[device_id], args.verbose)
+        return
+
     if args.device:
         device_ids = [args.device]
     else:
-        device_ids = get_all_devices(args.server)
+        device_ids = get_all_devices(args.server, session, args.timeout)
 
+    results, failures = fetch_all_stats(args.server, device_ids, args.hours,
+                                        args.workers, args.timeout, session)
     for device_id in device_ids:
-        stats = get_device_stats(args.server, device_id, args.hours)
-        print_stats(stats, args.verbose)
+        if device_id in results:
+            print_stats(results[device_id], args.verbose)
+
+    if failures:
+        for device_id, error in failures.items():
+            print(f"Error fetching stats for device {device_id}: {error}",
+                  file=sys.stderr)
+        print(f"Failed to fetch {len(failures)} of {len(device_ids)} devices",
+              file=sys.stderr)
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()
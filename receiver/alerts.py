@@ -0,0 +1,225 @@
+"""Alert rules evaluated incrementally as samples arrive.
+
+Rules live in a JSON file, a list of objects such as
+
+    {"name": "cpu-high", "metric": "cpu", "op": ">", "value": 90,
+     "for": 300, "severity": "critical"}
+    {"name": "disk-await", "metric": "disk.*.wait", "op": ">", "value": 50}
+    {"name": "memory-climb", "metric": "memory", "rate": true,
+     "op": ">", "value": 0.5, "for": 60}
+
+metric is a timeseries.metric_values() name and may be a glob. "for"
+(seconds, default 0) is how long the condition must hold before the
+alert fires, and "rate" compares the per-second change since the
+device's previous sample instead of the value itself.
+
+Each (device, rule, metric) keeps a few fields of state, so a sample
+costs the same however much history has been stored.
+"""
+import fnmatch
+import json
+import math
+import operator
+import os
+import time
+
+from timeseries import metric_values
+
+OPS = {'>': operator.gt, '>=': operator.ge, '<': operator.lt,
+       '<=': operator.le}
+
+
+class Rule:
+    def __init__(self, spec):
+        try:
+            self.name = str(spec['name'])
+            self.metric = str(spec['metric'])
+            self.op = spec.get('op', '>')
+            self.check = OPS[self.op]
+            self.value = float(spec['value'])
+            self.duration = float(spec.get('for', 0))
+        except KeyError as e:
+            raise ValueError(f"Rule {spec!r} has no or an unknown {e}")
+        except (AttributeError, TypeError) as e:
+            raise ValueError(f"Invalid rule {spec!r}: {e}")
+        self.rate = bool(spec.get('rate', False))
+        self.severity = spec.get('severity', 'warning')
+        self.spec = spec
+
+    def matches(self, metric):
+        return fnmatch.fnmatchcase(metric, self.metric)
+
+
+class AlertState:
+    __slots__ = ('since', 'firing', 'last_value', 'last_ts')
+
+    def __init__(self):
+        self.since = None  # when the condition started holding
+        self.firing = None  # the alert while it is firing
+        self.last_value = None  # previous sample, for rate rules
+        self.last_ts = None
+
+
+def load_rules(path):
+    with open(path, 'r') as f:
+        specs = json.load(f)
+    if not isinstance(specs, list):
+        raise ValueError("The rules file must hold a list of rules")
+    rules = [Rule(spec) for spec in specs]
+    names = [rule.name for rule in rules]
+    if len(set(names)) != len(names):
+        raise ValueError("Rule names must be unique")
+    return rules
+
+
+class AlertEngine:
+    """Per-device state machines for every rule in a rules file.
+
+    evaluate() returns the alerts that changed state with a sample, as
+    dicts with state 'firing' or 'resolved'. The rules file is re-read
+    when its mtime changes, checked at most every check_interval
+    seconds; state carries over for rules whose definition is unchanged
+    and alerts of removed or edited rules are resolved. A file that
+    fails to parse is reported and the previous rules stay in force.
+    """
+
+    def __init__(self, path, check_interval=5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.rules = []
+        self.transitions = 0
+        self._mtime = None
+        self._next_check = 0.0
+        self._by_metric = {}  # metric name -> rules that match it
+        self._state = {}  # device -> {(rule name, metric): AlertState}
+        self.reload()
+
+    def reload(self):
+        """Re-read the rules file if it changed; returns resolved alerts"""
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return []
+        try:
+            rules = load_rules(self.path) if mtime is not None else []
+        except (OSError, ValueError) as e:
+            print(f"Ignored invalid alert rules in {self.path}: {e}")
+            self._mtime = mtime
+            return []
+        self._mtime = mtime
+
+        kept = {rule.name for rule in rules
+                if any(old.name == rule.name and old.spec == rule.spec
+                       for old in self.rules)}
+        resolved = []
+        for device_id, states in self._state.items():
+            for key, state in list(states.items()):
+                if key[0] in kept:
+                    continue
+                if state.firing is not None:
+                    resolved.append(self._resolve(device_id, key))
+                del states[key]
+        self.rules = rules
+        self._by_metric = {}
+        if self.rules or resolved:
+            print(f"Loaded {len(rules)} alert rules from {self.path}")
+        return resolved
+
+    def maybe_reload(self):
+        now = time.monotonic()
+        if now < self._next_check:
+            return []
+        self._next_check = now + self.check_interval
+        return self.reload()
+
+    def _rules_for(self, metric):
+        rules = self._by_metric.get(metric)
+        if rules is None:
+            rules = self._by_metric[metric] = [
+                rule for rule in self.rules if rule.matches(metric)]
+        return rules
+
+    def _resolve(self, device_id, key):
+        rule = next(r for r in self.rules if r.name == key[0])
+        return self._alert(rule, device_id, key[1], 'resolved', None,
+                           time.time())
+
+    def _alert(self, rule, device_id, metric, state, value, timestamp):
+        self.transitions += 1
+        return {
+            'device': device_id,
+            'rule': rule.name,
+            'metric': metric,
+            'state': state,
+            'severity': rule.severity,
+            'value': value,
+            'threshold': rule.value,
+            'timestamp': timestamp
+        }
+
+    def evaluate(self, data):
+        if not self.rules:
+            return []
+        device_id = str(data['id'])
+        try:
+            timestamp = float(data.get('timestamp'))
+        except (TypeError, ValueError):
+            timestamp = time.time()
+
+        states = self._state.get(device_id)
+        if states is None:
+            states = self._state[device_id] = {}
+        alerts = []
+        for metric, value in metric_values(data):
+            for rule in self._rules_for(metric):
+                key = (rule.name, metric)
+                state = states.get(key)
+                if state is None:
+                    state = states[key] = AlertState()
+                observed = value
+                if rule.rate:
+                    last_value, last_ts = state.last_value, state.last_ts
+                    state.last_value, state.last_ts = value, timestamp
+                    if last_ts is None or timestamp <= last_ts:
+                        continue
+                    observed = (value - last_value) / (timestamp - last_ts)
+                if math.isnan(observed):
+                    continue
+
+                if rule.check(observed, rule.value):
+                    if state.since is None:
+                        state.since = timestamp
+                    if (state.firing is None
+                            and timestamp - state.since >= rule.duration):
+                        state.firing = self._alert(rule, device_id, metric,
+                                                   'firing', observed,
+                                                   timestamp)
+                        alerts.append(state.firing)
+                else:
+                    state.since = None
+                    if state.firing is not None:
+                        state.firing = None
+                        alerts.append(self._alert(rule, device_id, metric,
+                                                  'resolved', observed,
+                                                  timestamp))
+        return alerts
+
+    def forget(self, device_id):
+        """Drop a device's state; returns its firing alerts, resolved"""
+        states = self._state.pop(str(device_id), {})
+        return [self._resolve(str(device_id), key)
+                for key, state in states.items() if state.firing is not None]
+
+    def active(self):
+        """The alerts currently firing"""
+        return [state.firing for states in self._state.values()
+                for state in states.values() if state.firing is not None]
+
+
+def append_log(path, alerts):
+    """Append alert transitions to a JSON-lines log"""
+    with open(path, 'a') as f:
+        for alert in alerts:
+            f.write(json.dumps(alert, separators=(',', ':')) + '\n')
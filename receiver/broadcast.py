@@ -0,0 +1,126 @@
+import time
+
+
+class Subscriber:
+    """Broadcast state for one connected dashboard"""
+
+    def __init__(self):
+        self.devices = None  # None means every device
+        self.stale = None  # devices to send in full; None means all
+        self.awaiting_ack = False
+        self.sent_at = 0.0
+
+    def wants(self, device_id):
+        return self.devices is None or device_id in self.devices
+
+    def mark_stale(self, device_ids):
+        if self.stale is not None:
+            self.stale.update(device_ids)
+
+
+class Broadcaster:
+    """Coalesce packets into one batched, delta-only message per client.
+
+    publish() only records the newest packet per device. Every interval
+    seconds tick() diffs each changed packet against the one previously
+    broadcast, once, and sends every client a single 'updates' event:
+
+        {"full": {id: packet}, "delta": {id: {changed fields}}}
+
+    Clients only get the devices they subscribed to. A client that has not
+    acknowledged its previous batch is skipped, and the devices it missed
+    are sent to it in full once it catches up, so a slow dashboard drops
+    intermediate states instead of queueing them.
+    """
+
+    def __init__(self, socketio, interval=0.25, ack_timeout=5.0,
+                 metrics=None):
+        self.socketio = socketio
+        self.metrics = metrics
+        self.interval = interval
+        self.ack_timeout = ack_timeout
+        self.clients = {}
+        self.pending = {}
+        self.latest = {}
+        self._running = False
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self.socketio.start_background_task(self._run)
+
+    def _run(self):
+        while self._running:
+            self.socketio.sleep(self.interval)
+            self.tick()
+
+    def publish(self, device_id, data):
+        self.pending[str(device_id)] = data
+
+    def add_client(self, sid):
+        self.clients[sid] = Subscriber()
+
+    def remove_client(self, sid):
+        self.clients.pop(sid, None)
+
+    def subscribe(self, sid, device_ids):
+        client = self.clients.get(sid)
+        if client is None:
+            return
+        client.devices = set(map(str, device_ids)) if device_ids else None
+        client.stale = None
+
+    def ack(self, sid):
+        client = self.clients.get(sid)
+        if client is not None:
+            client.awaiting_ack = False
+
+    def tick(self):
+        start = time.perf_counter()
+        sent = skipped = 0
+        changed, self.pending = self.pending, {}
+        deltas = {}
+        for device_id, data in changed.items():
+            previous = self.latest.get(device_id)
+            if previous is None:
+                deltas[device_id] = data
+            else:
+                deltas[device_id] = {k: v for k, v in data.items()
+                                     if previous.get(k) != v}
+            self.latest[device_id] = data
+
+        now = time.monotonic()
+        for sid, client in list(self.clients.items()):
+            wanted = [d for d in changed if client.wants(d)]
+            if client.awaiting_ack and now - client.sent_at < self.ack_timeout:
+                client.mark_stale(wanted)
+                skipped += 1
+                continue
+            if client.awaiting_ack:
+                client.stale = None  # ack lost; resend everything
+
+            if client.stale is None:
+                full_ids = [d for d in self.latest if client.wants(d)]
+            else:
+                full_ids = [d for d in client.stale if d in self.latest]
+            full_set = set(full_ids)
+            message = {
+                'full': {d: self.latest[d] for d in full_ids},
+                'delta': {d: deltas[d] for d in wanted
+                          if d not in full_set and deltas[d]}
+            }
+            client.stale = set()
+            if not message['full'] and not message['delta']:
+                continue
+
+            client.awaiting_ack = True
+            client.sent_at = now
+            self.socketio.emit('updates', message, to=sid,
+                               callback=lambda *args, sid=sid: self.ack(sid))
+            sent += 1
+
+        if self.metrics is not None:
+            self.metrics.observe('broadcast_tick_seconds',
+                                 time.perf_counter() - start)
+            self.metrics.inc('broadcast_messages_total', sent)
+            self.metrics.inc('broadcast_skipped_total', skipped)
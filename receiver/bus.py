@@ -0,0 +1,257 @@
+"""Share ingested packets and alert transitions between receiver processes.
+
+A receiver started with --workers N runs N processes that accept
+connections on the same port (SO_REUSEPORT). Each process persists and
+evaluates alert rules on only what it ingests itself, and publishes the
+packets and any alert transitions on a bus; every other process applies
+them to its in-memory latest state and dashboard broadcaster, so a
+dashboard connected to any worker sees every agent and every alert.
+
+Under eventlet the socket and threading modules used here are green.
+"""
+import json
+import os
+import queue
+import socket
+import struct
+import sys
+import threading
+import time
+import uuid
+
+HEADER = struct.Struct('>I')
+
+
+class Bus:
+    """Base class for a bus; subclass it for other brokers.
+
+    publish() only queues a message; a flusher sends everything queued
+    every flush_interval seconds as one frame of the form
+    {"origin": ..., kind: [messages]}. start() calls handler(frame) for
+    every frame published by another process, and on_close() if the
+    connection to the bus is lost.
+    """
+
+    def __init__(self, flush_interval=0.05):
+        self.flush_interval = flush_interval
+        self.origin = uuid.uuid4().hex
+        self.published = 0
+        self.received = 0
+        self._outbox = {}
+        self._running = False
+
+    def publish(self, kind, message):
+        self._outbox.setdefault(kind, []).append(message)
+
+    def start(self, handler, on_close=None):
+        self._connect()
+        self._running = True
+        threading.Thread(target=self._flush_loop, daemon=True).start()
+        threading.Thread(target=self._receive_loop, args=(handler, on_close),
+                         daemon=True).start()
+
+    def _flush_loop(self):
+        while self._running:
+            time.sleep(self.flush_interval)
+            if not self._outbox:
+                continue
+            frame, self._outbox = self._outbox, {}
+            self.published += sum(map(len, frame.values()))
+            frame['origin'] = self.origin
+            try:
+                self._send(json.dumps(frame, separators=(',', ':')).encode())
+            except OSError as e:
+                print(f"Bus send failed: {e}", file=sys.stderr)
+
+    def _receive_loop(self, handler, on_close):
+        try:
+            for payload in self._receive():
+                frame = json.loads(payload)
+                if frame.pop('origin', None) == self.origin:
+                    continue
+                self.received += sum(map(len, frame.values()))
+                handler(frame)
+        except (OSError, ValueError) as e:
+            print(f"Bus receive failed: {e}", file=sys.stderr)
+        if self._running and on_close is not None:
+            on_close()
+
+    def close(self):
+        self._running = False
+
+    def _connect(self):
+        raise NotImplementedError
+
+    def _send(self, payload):
+        raise NotImplementedError
+
+    def _receive(self):
+        """Yield the payload of every frame until the bus goes away"""
+        raise NotImplementedError
+
+
+def read_frame(sock):
+    """Read one length-prefixed frame; None once the peer has closed"""
+    header = read_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    return read_exactly(sock, HEADER.unpack(header)[0])
+
+
+def read_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return None
+        data += chunk
+    return bytes(data)
+
+
+class UnixBus(Bus):
+    """Client of the Unix socket hub run by the first worker"""
+
+    def __init__(self, path, flush_interval=0.05, connect_timeout=10):
+        super().__init__(flush_interval)
+        self.path = path
+        self.connect_timeout = connect_timeout
+        self._sock = None
+
+    def _connect(self):
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.path)
+                self._sock = sock
+                return
+            except OSError:
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.1)
+
+    def _send(self, payload):
+        self._sock.sendall(HEADER.pack(len(payload)) + payload)
+
+    def _receive(self):
+        while True:
+            payload = read_frame(self._sock)
+            if payload is None:
+                return
+            yield payload
+
+    def close(self):
+        super().close()
+        if self._sock is not None:
+            self._sock.close()
+
+
+class UnixHub:
+    """Relay every frame from one worker to all the others.
+
+    Frames are forwarded without being decoded. Each peer has its own
+    bounded send queue and writer, so a stalled worker loses frames
+    instead of holding up the rest.
+    """
+
+    def __init__(self, path, max_queue=1000):
+        self.path = path
+        self.max_queue = max_queue
+        self.dropped = 0
+        self._peers = {}
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(64)
+        threading.Thread(target=self._accept_loop, args=(server,),
+                         daemon=True).start()
+
+    def _accept_loop(self, server):
+        while True:
+            conn, _ = server.accept()
+            outbox = queue.Queue(maxsize=self.max_queue)
+            self._peers[conn] = outbox
+            threading.Thread(target=self._read_loop, args=(conn,),
+                             daemon=True).start()
+            threading.Thread(target=self._write_loop, args=(conn, outbox),
+                             daemon=True).start()
+
+    def _read_loop(self, conn):
+        try:
+            while True:
+                payload = read_frame(conn)
+                if payload is None:
+                    break
+                frame = HEADER.pack(len(payload)) + payload
+                for peer, outbox in list(self._peers.items()):
+                    if peer is conn:
+                        continue
+                    try:
+                        outbox.put_nowait(frame)
+                    except queue.Full:
+                        self.dropped += 1
+        except OSError:
+            pass
+        outbox = self._peers.pop(conn, None)
+        conn.close()
+        try:
+            outbox.put_nowait(None)  # a full queue's writer fails on close
+        except queue.Full:
+            pass
+
+    def _write_loop(self, conn, outbox):
+        while True:
+            frame = outbox.get()
+            if frame is None:
+                return
+            try:
+                conn.sendall(frame)
+            except OSError:
+                return
+
+
+class RedisBus(Bus):
+    """Redis pub/sub, for receivers on several hosts behind a load balancer"""
+
+    def __init__(self, url, channel='sysmon', flush_interval=0.05):
+        super().__init__(flush_interval)
+        try:
+            import redis
+        except ImportError:
+            print("A redis:// bus needs the redis package", file=sys.stderr)
+            sys.exit(1)
+        self._client = redis.Redis.from_url(url)
+        self.channel = channel
+        self._pubsub = None
+
+    def _connect(self):
+        self._pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self.channel)
+
+    def _send(self, payload):
+        self._client.publish(self.channel, payload)
+
+    def _receive(self):
+        for message in self._pubsub.listen():
+            yield message['data']
+
+    def close(self):
+        super().close()
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+
+BUSES = {'unix': UnixBus, 'redis': RedisBus, 'rediss': RedisBus}
+
+
+def make_bus(url):
+    """Build a bus from unix:/path/to.sock or redis://host:port/db"""
+    scheme, _, rest = url.partition(':')
+    if scheme not in BUSES:
+        raise ValueError(f"Unknown bus {url!r}; expected "
+                         + ' or '.join(f"{s}:" for s in BUSES))
+    return BUSES[scheme](rest if scheme == 'unix' else url)
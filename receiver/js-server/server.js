@@ -37,7 +37,8 @@ async function startServer() {
     console.log('Database initialized');
 
     app.use(express.static('public'));
-    app.use(express.json());
+    // Bulk uploads from spooled agents can be large once decompressed
+    app.use(express.json({ limit: '10mb' }));
 
     const server = app.listen(port, () => {
         console.log(`Server running at http://localhost:${port}`);
@@ -56,7 +57,20 @@ async function startServer() {
                data.disk;
     }
 
-    async function storeDeviceData(data) {
+    // Every write goes through this promise chain, so a bulk upload's
+    // transaction never interleaves with (or rolls back) another write
+    let writeChain = Promise.resolve();
+    function withWriteLock(fn) {
+        const result = writeChain.then(fn);
+        writeChain = result.catch(() => {});
+        return result;
+    }
+
+    function storeDeviceData(data) {
+        return withWriteLock(() => insertDeviceData(data));
+    }
+
+    async function insertDeviceData(data) {
         try {
             await db.run(`
                 INSERT OR REPLACE INTO device_stats (
@@ -124,8 +138,18 @@ async function startServer() {
         });
     }
 
+    // Only JSON is understood here. A 415 (rather than the 400 an
+    // unparsed body would get) tells agents sending the compact encoding
+    // to fall back to JSON.
+    function requireJson(req, res, next) {
+        if (req.is('application/json') === false) {
+            return res.status(415).json({ error: 'Unsupported media type' });
+        }
+        next();
+    }
+
     // API Endpoints
-    app.post('/data', async (req, res) => {
+    app.post('/data', requireJson, async (req, res) => {
         try {
             const data = req.body;
             if (validateData(data)) {
@@ -141,6 +165,49 @@ async function startServer() {
         }
     });
 
+    // Batched upload from an agent's spool (gzip Content-Encoding is
+    // inflated by express.json)
+    app.post('/data/bulk', requireJson, async (req, res) => {
+        const batch = req.body;
+        if (!Array.isArray(batch)) {
+            return res.status(400).json({ error: 'Expected an array of samples' });
+        }
+        const latest = new Map();
+        let stored = 0;
+        try {
+            // All or nothing, so a 500 never follows a partial write
+            await withWriteLock(async () => {
+                await db.exec('BEGIN');
+                try {
+                    for (const data of batch) {
+                        if (!validateData(data)) continue;
+                        await insertDeviceData(data);
+                        stored++;
+                        const current = latest.get(data.id);
+                        if (!current || current.timestamp <= data.timestamp) {
+                            latest.set(data.id, data);
+                        }
+                    }
+                    await db.exec('COMMIT');
+                } catch (e) {
+                    await db.exec('ROLLBACK').catch(() => {});
+                    throw e;
+                }
+            });
+        } catch (e) {
+            return res.status(500).json({ error: 'Server error' });
+        }
+
+        latest.forEach((data, id) => {
+            const current = recentDeviceData.get(id);
+            if (!current || current.timestamp <= data.timestamp) {
+                recentDeviceData.set(id, data);
+                broadcastDeviceUpdate(id);
+            }
+        });
+        res.json({ status: 'success', count: stored });
+    });
+
     app.get('/devices', async (req, res) => {
         try {
             const devices = await db.all('SELECT DISTINCT device_id FROM device_stats');
@@ -150,6 +217,46 @@ async function startServer() {
         }
     });
 
+    // Latest rows for many devices in one round trip. ids is a
+    // comma-separated list (all devices when omitted); limit is per device.
+    app.get('/devices/stats', async (req, res) => {
+        try {
+            const limit = parseInt(req.query.limit) || 100;
+            const ids = req.query.ids ? String(req.query.ids).split(',') : null;
+            const cutoff = req.query.hours
+                ? Math.floor(Date.now() / 1000) - (parseInt(req.query.hours) * 3600)
+                : 0;
+
+            const filter = ids ? `AND device_id IN (${ids.map(() => '?').join(',')})` : '';
+            const rows = await db.all(
+                `SELECT * FROM (
+                     SELECT *, ROW_NUMBER() OVER (
+                         PARTITION BY device_id ORDER BY timestamp DESC
+                     ) AS rn
+                     FROM device_stats
+                     WHERE timestamp >= ? ${filter}
+                 )
+                 WHERE rn <= ?
+                 ORDER BY device_id, timestamp DESC`,
+                [cutoff, ...(ids || []), limit]
+            );
+
+            const result = {};
+            rows.forEach(({ rn, ...row }) => {
+                if (!result[row.device_id]) result[row.device_id] = [];
+                result[row.device_id].push({
+                    ...row,
+                    network: JSON.parse(row.network_data),
+                    disk: JSON.parse(row.disk_data)
+                });
+            });
+
+            res.json(result);
+        } catch (e) {
+            res.status(500).json({ error: 'Database error' });
+        }
+    });
+
     app.get('/data/:id', async (req, res) => {
         try {
             const { id } = req.params;
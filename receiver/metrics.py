@@ -0,0 +1,109 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5)
+
+
+def escape(value):
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+class Metrics:
+    """Counters, gauges and latency histograms in Prometheus text format.
+
+    Recording is a dict update (plus a bisect for histograms) under one
+    lock, so it is cheap enough for the ingest path. Gauges that are
+    expensive or live elsewhere (queue depths, client counts) are
+    registered as callbacks and only evaluated when /metrics is scraped.
+    labels are added to every series, e.g. the worker index when several
+    receiver processes share a port.
+    """
+
+    def __init__(self, prefix, labels=None):
+        self.prefix = prefix
+        self.labels = tuple(sorted((labels or {}).items()))
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._callbacks = {}
+        self._histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def callback(self, name, fn, kind='gauge'):
+        """Report fn() under name whenever the metrics are rendered"""
+        self._callbacks[name] = (fn, kind)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [
+                    [0] * (len(DEFAULT_BUCKETS) + 1), 0.0, 0]
+            hist[0][bisect.bisect_left(DEFAULT_BUCKETS, seconds)] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        p = self.prefix
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2]))
+                                for k, v in self._histograms.items())
+        const = self.labels
+
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{p}_{name}{format_labels(const + labels)} {value}")
+        for (name, labels), value in gauges:
+            header(name, 'gauge')
+            lines.append(f"{p}_{name}{format_labels(const + labels)} {value}")
+        for name, (fn, kind) in sorted(self._callbacks.items()):
+            header(name, kind)
+            lines.append(f"{p}_{name}{format_labels(const)} {fn()}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(DEFAULT_BUCKETS + ('+Inf',), buckets):
+                cumulative += n
+                le = const + labels + (('le', bound),)
+                lines.append(f"{p}_{name}_bucket{format_labels(le)} {cumulative}")
+            lines.append(f"{p}_{name}_sum{format_labels(const + labels)} {total}")
+            lines.append(f"{p}_{name}_count{format_labels(const + labels)} {count}")
+        return '\n'.join(lines) + '\n'
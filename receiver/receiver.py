@@ -1,31 +1,577 @@
 import eventlet
 eventlet.monkey_patch()
 
-from flask import Flask, render_template, request, jsonify
+import argparse
+import atexit
+import gzip
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from collections import OrderedDict
+
+import eventlet.wsgi
+from flask import Flask, Response, g, render_template, request, jsonify
 from flask_socketio import SocketIO, emit
 from flask_cors import CORS
 
+try:
+    import msgpack
+except ImportError:  # compact encoding is optional
+    msgpack = None
+
+import rollup
+from alerts import AlertEngine, append_log
+from broadcast import Broadcaster
+from bus import UnixHub, make_bus
+from metrics import Metrics
+from storage import WriteBehindStore
+from timeseries import TimeSeriesStore
+
+COMPACT_CONTENT_TYPE = 'application/x-sysmon-compact'
+RING_CAPACITY = 720  # samples kept in memory per device (1h at 5s)
+RESTORE_WINDOW = 3600  # seconds of history reloaded into the rings at startup
+BROADCAST_INTERVAL = 0.25  # seconds between batched dashboard updates
+DB_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'devices.db')
+FLUSH_INTERVAL = 0.5  # seconds between group commits
+FLUSH_BATCH_SIZE = 5000  # commit early once this many samples are queued
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'alert_rules.json')
+ALERT_LOG = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         'alerts.log')
+
 app = Flask(__name__, static_url_path='', static_folder='static')
 CORS(app, origins=["*"])  # For development, you can restrict this later
 
 socketio = SocketIO(app, cors_allowed_origins="*")
+metrics = Metrics('sysmon_receiver')
 data_store = {}  # Stores latest data per id
+bus = None  # shares ingested packets with the other workers, if any
+worker_metrics_port = None  # set when several workers share the port
+alert_engine = AlertEngine(RULES_FILE)
+alert_log = ALERT_LOG  # None in spawned workers; the first one logs
+remote_alerts = {}  # (device, rule, metric) -> alert firing on another worker
+series_store = TimeSeriesStore(capacity=RING_CAPACITY)  # Recent history per id
+broadcaster = Broadcaster(socketio, interval=BROADCAST_INTERVAL,
+                          metrics=metrics)
+db = WriteBehindStore(DB_FILE, flush_interval=FLUSH_INTERVAL,
+                      batch_size=FLUSH_BATCH_SIZE)
+atexit.register(db.close)  # flush queued samples on clean shutdown
+
+# Restore state from the database after a restart
+for packet in db.load_since(time.time() - RESTORE_WINDOW, RING_CAPACITY):
+    series_store.append(packet)
+for packet in db.load_latest():
+    data_store[packet['id']] = packet
+    broadcaster.latest[str(packet['id'])] = packet
+
+
+metrics.callback('connected_clients', lambda: len(broadcaster.clients))
+metrics.callback('broadcast_pending', lambda: len(broadcaster.pending))
+metrics.callback('db_queue_depth', db.depth)
+metrics.callback('db_written_total', lambda: db.written, 'counter')
+metrics.callback('db_dropped_total', lambda: db.dropped, 'counter')
+metrics.callback('devices', lambda: len(data_store))
+metrics.callback('alerts_firing', lambda: len(alert_engine.active()))
+
+
+class StreamStateError(ValueError):
+    """A delta frame arrived for a stream we have no matching state for"""
+
+
+class CompactDecoder:
+    """Decode frames written by the sender's CompactEncoder.
+
+    Keeps the name dictionary and previous integer fields for each stream
+    id, bounded to max_streams with least-recently-used eviction. Numbers
+    come back typed rather than as the strings the JSON format uses, and
+    float32 fields are rounded to two places.
+    A malformed frame raises ValueError and leaves the stream untouched.
+    """
+
+    def __init__(self, max_streams=10000):
+        self.max_streams = max_streams
+        self._streams = OrderedDict()
+
+    def decode_frame(self, frame):
+        try:
+            (stream, seq, keyframe, device_id, new_names, timestamp, cpu,
+             memfree, memused, mem_percent, network, disk, extra) = frame
+        except (TypeError, ValueError):
+            raise ValueError("Malformed compact frame")
+
+        streams = self._streams
+        if keyframe:
+            names, ints = [], (0, 0, 0)
+        else:
+            state = streams.get(stream)
+            if state is None or state['seq'] != seq - 1:
+                streams.pop(stream, None)
+                raise StreamStateError(f"Out of sync on stream {stream}")
+            device_id, names, ints = state['id'], state['names'], state['ints']
+
+        try:
+            if new_names:
+                names = names + list(new_names)
+            current = (timestamp, memfree, memused)
+            if not keyframe:
+                current = tuple(d + p for d, p in zip(current, ints))
+            if len(network) % 3 or len(disk) % 3:
+                raise ValueError("network/disk lists are not triples")
+            data = {
+                "id": device_id,
+                "timestamp": current[0],
+                "cpu_usage_percent": None if cpu is None else round(cpu, 2),
+                "memory": {
+                    "kbmemfree": current[1],
+                    "kbmemused": current[2],
+                    "memused_percent": None if mem_percent is None
+                    else round(mem_percent, 2)
+                },
+                "network": [
+                    {'iface': names[network[i]],
+                     'rx_kb': round(network[i + 1], 2),
+                     'tx_kb': round(network[i + 2], 2)}
+                    for i in range(0, len(network), 3)
+                ],
+                "disk": [
+                    {'device': names[disk[i]],
+                     'wait': round(disk[i + 1], 2),
+                     'util': round(disk[i + 2], 2)}
+                    for i in range(0, len(disk), 3)
+                ]
+            }
+            if extra:
+                data.update(extra)
+        except (IndexError, TypeError, ValueError) as e:
+            raise ValueError(f"Malformed compact frame: {e}")
+
+        # Only a frame that decoded cleanly moves the stream forward
+        streams[stream] = {'id': device_id, 'names': names, 'ints': current,
+                           'seq': seq}
+        streams.move_to_end(stream)
+        while len(streams) > self.max_streams:
+            streams.popitem(last=False)
+        return data
+
+    def stream_count(self):
+        return len(self._streams)
+
+    def decode(self, body):
+        return self.decode_frame(msgpack.unpackb(body))
+
+    def decode_batch(self, body):
+        """Decode a bulk upload; streams carry over between batches"""
+        frames = msgpack.unpackb(body)
+        if not isinstance(frames, list):
+            raise ValueError("Expected an array of frames")
+        return [self.decode_frame(frame) for frame in frames]
+
+
+compact_decoder = CompactDecoder()
+metrics.callback('compact_streams', compact_decoder.stream_count)
+
+def is_compact(req):
+    return req.mimetype == COMPACT_CONTENT_TYPE
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+@app.after_request
+def record_latency(response):
+    if 'request_start' in g and request.endpoint != 'prometheus_metrics':
+        metrics.observe('handler_seconds',
+                        time.perf_counter() - g.request_start,
+                        handler=request.endpoint or 'unknown')
+    return response
+
+@app.route('/metrics')
+def prometheus_metrics():
+    if worker_metrics_port is not None:
+        # Scrapes of the shared port would land on a random worker
+        return jsonify({'error': 'Each worker serves its own /metrics',
+                        'port': worker_metrics_port}), 404
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+def metrics_app(environ, start_response):
+    """Bare WSGI app for a worker's own metrics port"""
+    if environ.get('PATH_INFO') != '/metrics':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not found\n']
+    body = metrics.render().encode()
+    start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
 
 @app.route('/')
 def index():
     return app.send_static_file('index.html')
 
-@socketio.on('json_data')
-def handle_json_data(data):
+# Values that fit a device_stats column as they are
+SCALARS = (str, int, float, type(None))
+
+def packet_problem(data):
+    """Why a packet cannot be stored, or None if it is well formed"""
     if not isinstance(data, dict) or "id" not in data:
-        print("Ignored packet without 'id':", data)
-        return
+        return "no 'id'"
+    if isinstance(data["id"], bool) or not isinstance(data["id"], (str, int)):
+        return "'id' is not a string or integer"
+    if not isinstance(data.get("timestamp"), (int, float, type(None))):
+        return "'timestamp' is not a number"
+    if not isinstance(data.get("cpu_usage_percent"), SCALARS):
+        return "'cpu_usage_percent' is not a number"
+    memory = data.get("memory")
+    if memory is None:
+        memory = {}
+    elif not isinstance(memory, dict):
+        return "'memory' is not an object"
+    if not all(isinstance(value, SCALARS) for value in memory.values()):
+        return "a 'memory' field is not a number or string"
+    for key in ("network", "disk"):
+        if not isinstance(data.get(key), (list, type(None))):
+            return f"'{key}' is not an array"
+    return None
+
+def is_newest(data):
+    """True if data is newer than the device's latest state.
+
+    A sample with the same timestamp is a resend, which the agents'
+    at-least-once delivery makes routine. Packets without a timestamp
+    always count as newest.
+    """
+    current = data_store.get(data["id"])
+    timestamp = data.get("timestamp")
+    if current is None or timestamp is None:
+        return True
+    return (current.get("timestamp") or 0) < timestamp
+
+def store_packet(data):
+    """Store a packet and queue it for dashboards; False if it is invalid.
+
+    The packet is checked before any state changes, so a malformed one
+    leaves nothing half stored. A sample older than the device's latest
+    state, such as spooled backlog arriving after a reconnect, is only
+    persisted: the latest state, ring buffer, dashboards and alerts move
+    forward in time only, as in the Node server's /data/bulk.
+    """
+    problem = packet_problem(data)
+    if problem is not None:
+        print(f"Ignored packet with {problem}:", data)
+        metrics.inc('rejected_total')
+        return False
     id_val = data["id"]
+    metrics.inc('ingest_samples_total', device=id_val)
+    db.put(data)
+    if not is_newest(data):
+        return True
     data_store[id_val] = data
-    print(f"Received and stored data for id={id_val}")
-    # Emit the event with data formatted correctly
-    emit('update', {str(id_val): data}, broadcast=True)  # Ensure id is a string key
+    series_store.append(data)
+    broadcaster.publish(id_val, data)
+    check_alerts(data)
+    if bus is not None:
+        bus.publish('packets', data)
+    return True
+
+def apply_bus_frame(frame):
+    """Apply what another worker ingested.
+
+    That worker persists its packets and evaluates their alerts, so here
+    a packet only updates the latest state and the dashboards. Ring
+    buffers and alert state stay with the ingesting worker: a device
+    that shows up from another worker (its agent reconnected and landed
+    there) has both dropped here, and any alert that was firing for it
+    is resolved so the new worker can raise it again.
+    """
+    for data in frame.get('packets', ()):
+        if not is_newest(data):
+            continue
+        id_val = data['id']
+        data_store[id_val] = data
+        broadcaster.publish(id_val, data)
+        if series_store.discard(id_val):
+            notify_alerts(alert_engine.forget(id_val))
+    alerts = frame.get('alerts')
+    if alerts:
+        for alert in alerts:
+            key = (alert['device'], alert['rule'], alert['metric'])
+            if alert['state'] == 'firing':
+                remote_alerts[key] = alert
+            else:
+                remote_alerts.pop(key, None)
+        socketio.emit('alerts', alerts)
+        log_alerts(alerts)
+
+def check_alerts(data):
+    """Run the alert rules on a packet this worker ingested"""
+    notify_alerts(alert_engine.maybe_reload() + alert_engine.evaluate(data))
+
+def notify_alerts(alerts):
+    """Count and push alert state changes and share them on the bus"""
+    if not alerts:
+        return
+    for alert in alerts:
+        metrics.inc('alert_transitions_total', state=alert['state'])
+        if bus is not None:
+            bus.publish('alerts', alert)
+    socketio.emit('alerts', alerts)
+    log_alerts(alerts)
+
+def log_alerts(alerts):
+    if alert_log is not None:
+        try:
+            append_log(alert_log, alerts)
+        except OSError as e:
+            print(f"Could not write {alert_log}: {e}")
+
+def firing_alerts():
+    """Alerts firing here and, with several workers, on the others"""
+    return alert_engine.active() + list(remote_alerts.values())
+
+@socketio.on('connect')
+def handle_connect():
+    broadcaster.start()
+    broadcaster.add_client(request.sid)
+    active = firing_alerts()
+    if active:
+        emit('alerts', active)
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    broadcaster.remove_client(request.sid)
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Limit this client to {'devices': [ids]}; an empty list means all"""
+    devices = data.get('devices') if isinstance(data, dict) else None
+    broadcaster.subscribe(request.sid, devices or None)
+
+@socketio.on('json_data')
+def handle_json_data(data):
+    with metrics.timer('handler_seconds', handler='socket_json_data'):
+        ingest_socket_packet(data)
+
+def ingest_socket_packet(data):
+    if isinstance(data, bytes):
+        if msgpack is None:
+            print("Ignored compact packet: msgpack is not installed")
+            return
+        try:
+            data = compact_decoder.decode(data)
+        except (StreamStateError, ValueError, TypeError) as e:
+            print(f"Ignored compact packet: {e}")
+            return
+    store_packet(data)
+
+@app.route('/data', methods=['POST'])
+def post_data():
+    if is_compact(request):
+        if msgpack is None:
+            return jsonify({'error': 'Compact encoding not supported'}), 415
+        try:
+            data = compact_decoder.decode(request.get_data())
+        except StreamStateError as e:
+            return jsonify({'error': str(e)}), 409
+        except (ValueError, TypeError):
+            return jsonify({'error': 'Invalid data format'}), 400
+    else:
+        data = request.get_json(silent=True)
+    if not store_packet(data):
+        return jsonify({'error': 'Invalid data format'}), 400
+    return jsonify({'status': 'success', 'id': data['id']})
+
+@app.route('/data/bulk', methods=['POST'])
+def post_bulk():
+    """Batched upload from an agent's spool, optionally gzip-compressed"""
+    if is_compact(request) and msgpack is None:
+        return jsonify({'error': 'Compact encoding not supported'}), 415
+    body = request.get_data()
+    try:
+        if request.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        if is_compact(request):
+            batch = compact_decoder.decode_batch(body)
+        else:
+            batch = json.loads(body)
+    except StreamStateError as e:
+        return jsonify({'error': str(e)}), 409
+    except (OSError, EOFError, zlib.error, ValueError, TypeError):
+        return jsonify({'error': 'Invalid data format'}), 400
+    if not isinstance(batch, list):
+        return jsonify({'error': 'Expected an array of samples'}), 400
+    stored = sum(1 for data in batch if store_packet(data))
+    return jsonify({'status': 'success', 'count': stored})
+
+def time_range():
+    """Read ?minutes= or ?start=&end= (unix seconds) from the request"""
+    minutes = request.args.get('minutes', type=float)
+    if minutes is not None:
+        return time.time() - minutes * 60, None
+    return request.args.get('start', type=float), request.args.get('end', type=float)
+
+@app.route('/api/alerts')
+def active_alerts():
+    return jsonify({'active': firing_alerts(),
+                    'rules': [rule.spec for rule in alert_engine.rules]})
+
+def device_ring(device_id):
+    """A device's ring buffer, read back from the database when another
+    worker ingests the device"""
+    device = series_store.get(device_id)
+    if device is not None or bus is None:
+        return device
+    ring = TimeSeriesStore(capacity=RING_CAPACITY, max_devices=1)
+    for packet in db.load_device(device_id, time.time() - RESTORE_WINDOW,
+                                 RING_CAPACITY):
+        ring.append(packet)
+    return ring.get(device_id)
+
+@app.route('/api/device/<device_id>/series')
+def device_series(device_id):
+    device = device_ring(device_id)
+    if device is None:
+        return jsonify({'error': 'Unknown device'}), 404
+    since, until = time_range()
+    names = request.args.getlist('metric') or sorted(device.columns)
+    result = {}
+    for metric in names:
+        timestamps, values = device.series(metric, since, until)
+        result[metric] = {'timestamps': timestamps, 'values': values}
+    return jsonify(result)
+
+@app.route('/api/device/<device_id>/aggregate')
+def device_aggregate(device_id):
+    device = device_ring(device_id)
+    if device is None:
+        return jsonify({'error': 'Unknown device'}), 404
+    since, until = time_range()
+    names = request.args.getlist('metric') or sorted(device.columns)
+    return jsonify({metric: device.aggregate(metric, since, until)
+                    for metric in names})
+
+@app.route('/api/device/<device_id>/history')
+def device_history(device_id):
+    """Long-range history served from the coarsest rollup tier that fits.
+
+    Takes ?hours= or ?start=&end=, plus optional ?step= (seconds per
+    point) and ?stat=avg|min|max|last.
+    """
+    hours = request.args.get('hours', type=float)
+    if hours is not None:
+        end = time.time()
+        start = end - hours * 3600
+    else:
+        start = request.args.get('start', type=float)
+        end = request.args.get('end', type=float)
+        if start is None or end is None:
+            return jsonify({'error': 'Invalid time range parameters'}), 400
+    stat = request.args.get('stat', 'avg')
+    if stat not in rollup.STATS:
+        return jsonify({'error': 'Invalid stat'}), 400
+    return jsonify(db.history(device_id, int(start), int(end),
+                              request.args.get('step', type=float), stat))
+
+def stop_workers(workers):
+    for worker in workers:
+        worker.terminate()
+    for worker in workers:
+        try:
+            worker.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            worker.kill()
+
+def serve(args):
+    """Run as one of several processes sharing the port and a bus.
+
+    The first process hosts the Unix socket hub (unless an external bus
+    was given) and starts the other workers; the kernel spreads incoming
+    connections across them with SO_REUSEPORT. Worker i labels its
+    metrics worker="i" and serves them on metrics_port + i.
+    """
+    global bus, worker_metrics_port
+    if args.metrics_port is None and args.workers > 1:
+        args.metrics_port = args.port + 1
+    if args.metrics_port is not None:
+        port = args.metrics_port + args.worker_index
+        if args.workers > 1 or args.reuse_port:
+            worker_metrics_port = port
+            metrics.labels = (('worker', str(args.worker_index)),)
+        eventlet.spawn(eventlet.wsgi.server,
+                       eventlet.listen((args.host, port)),
+                       metrics_app, log_output=False)
+
+    if args.workers > 1:
+        if args.bus is None:
+            path = os.path.join(tempfile.gettempdir(),
+                                f"sysmon-bus-{os.getpid()}.sock")
+            hub = UnixHub(path)
+            hub.start()
+            atexit.register(os.unlink, path)
+            metrics.callback('bus_hub_dropped_total', lambda: hub.dropped,
+                             'counter')
+            args.bus = f"unix:{path}"
+        command = [sys.executable, os.path.abspath(__file__),
+                   '--host', args.host, '--port', str(args.port),
+                   '--bus', args.bus, '--rules', args.rules,
+                   '--metrics-port', str(args.metrics_port), '--reuse-port']
+        workers = [subprocess.Popen(command + ['--worker-index', str(i)])
+                   for i in range(1, args.workers)]
+        atexit.register(stop_workers, workers)
+
+    if args.bus is not None:
+        bus = make_bus(args.bus)
+        metrics.callback('bus_published_total', lambda: bus.published,
+                         'counter')
+        metrics.callback('bus_received_total', lambda: bus.received,
+                         'counter')
+        # Losing the bus would silently split the dashboards' view; exit
+        bus.start(apply_bus_frame,
+                  on_close=lambda: os.kill(os.getpid(), signal.SIGTERM))
+    sock = eventlet.listen((args.host, args.port),
+                           reuse_port=args.workers > 1 or args.reuse_port)
+    eventlet.wsgi.server(sock, app, log_output=False)
 
 if __name__ == '__main__':
-    socketio.run(app, host='0.0.0.0', port=8000, debug=True)
+    parser = argparse.ArgumentParser(
+        description='Receive device stats and broadcast them to dashboards',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter
+    )
+    parser.add_argument('--host', default='0.0.0.0', help='Address to bind')
+    parser.add_argument('-p', '--port', type=int, default=8000,
+                        help='Port to listen on')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Number of worker processes sharing the port')
+    parser.add_argument('--bus',
+                        help='Bus shared with other receivers, e.g. '
+                             'redis://host:6379/0 (default: a Unix socket '
+                             'hub when --workers > 1)')
+    parser.add_argument('--rules', default=RULES_FILE,
+                        help='Alert rules file, re-read when it changes')
+    parser.add_argument('--alert-log', default=ALERT_LOG,
+                        help='File alert transitions are appended to')
+    parser.add_argument('--metrics-port', type=int,
+                        help='Serve each worker\'s /metrics on its own port, '
+                             'this one plus the worker index (default: '
+                             '--port + 1 when --workers > 1)')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help=argparse.SUPPRESS)  # set for spawned workers
+    parser.add_argument('--worker-index', type=int, default=0,
+                        help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.rules != RULES_FILE:
+        alert_engine = AlertEngine(args.rules)
+    alert_log = None if args.reuse_port else args.alert_log
+
+    # Turn SIGTERM into a normal exit so atexit flushes the write queue
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    if args.workers == 1 and args.bus is None and args.metrics_port is None:
+        socketio.run(app, host=args.host, port=args.port, debug=True)
+    else:
+        serve(args)
 
@@ -0,0 +1,197 @@
+import time
+
+from timeseries import metric_values
+
+# (table, bucket seconds, retention seconds or None to keep forever).
+# The raw device_stats table is tier 0.
+RAW_RETENTION = 7 * 86400
+TIERS = [
+    ('device_rollup_1m', 60, 30 * 86400),
+    ('device_rollup_1h', 3600, 365 * 86400),
+    ('device_rollup_1d', 86400, None),
+]
+
+STATS = ('avg', 'min', 'max', 'last')
+
+
+def ensure_schema(conn):
+    # Retention deletes by time; without these compact() scans every table
+    conn.execute("""CREATE INDEX IF NOT EXISTS device_stats_timestamp
+                    ON device_stats (timestamp)""")
+    for table, _, _ in TIERS:
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                device_id TEXT,
+                bucket INTEGER,
+                metric TEXT,
+                count INTEGER,
+                sum REAL,
+                min REAL,
+                max REAL,
+                last REAL,
+                last_ts INTEGER,
+                PRIMARY KEY (device_id, bucket, metric)
+            )
+        """)
+        conn.execute(f"""CREATE INDEX IF NOT EXISTS {table}_bucket
+                         ON {table} (bucket)""")
+
+
+def merge(agg, other):
+    """Fold the partial aggregate other into agg"""
+    agg[0] += other[0]
+    agg[1] += other[1]
+    agg[2] = min(agg[2], other[2])
+    agg[3] = max(agg[3], other[3])
+    if other[5] >= agg[5]:
+        agg[4], agg[5] = other[4], other[5]
+
+
+class Partials:
+    """Rollup aggregates not yet written to the tier tables.
+
+    add() folds samples in memory into buckets of the finest tier only.
+    flush() derives the coarser tiers from those buckets and upserts
+    every (device, bucket, metric) once per tier, so the database sees
+    one row per bucket per flush however many samples fell into it.
+    Upserts add to what is stored, so a bucket flushed while still open
+    keeps accumulating correctly.
+    """
+
+    def __init__(self):
+        self.buckets = {}  # (device, 1m bucket, metric) -> aggregate
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def add(self, batch):
+        size = TIERS[0][1]
+        buckets = self.buckets
+        for data in batch:
+            try:
+                device_id = str(data['id'])
+                ts = int(data['timestamp'])
+            except (KeyError, TypeError, ValueError):
+                continue
+            bucket = ts - ts % size
+            for name, value in metric_values(data):
+                if value != value:  # NaN
+                    continue
+                key = (device_id, bucket, name)
+                agg = buckets.get(key)
+                if agg is None:
+                    buckets[key] = [1, value, value, value, value, ts]
+                    continue
+                agg[0] += 1
+                agg[1] += value
+                if value < agg[2]:
+                    agg[2] = value
+                elif value > agg[3]:
+                    agg[3] = value
+                if ts >= agg[5]:
+                    agg[4] = value
+                    agg[5] = ts
+
+    def flush(self, conn):
+        """Upsert everything held into every tier, in the caller's
+        transaction; the partials are kept if it raises"""
+        tier = self.buckets
+        for table, size, _ in TIERS:
+            if size != TIERS[0][1]:
+                # Each tier is built from the one below, which is smaller
+                # than the samples or buckets behind it
+                coarser = {}
+                for (device_id, bucket, name), agg in tier.items():
+                    key = (device_id, bucket - bucket % size, name)
+                    if key in coarser:
+                        merge(coarser[key], agg)
+                    else:
+                        coarser[key] = list(agg)
+                tier = coarser
+            conn.executemany(f"""
+                INSERT INTO {table} (device_id, bucket, metric, count, sum,
+                                     min, max, last, last_ts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (device_id, bucket, metric) DO UPDATE SET
+                    count = count + excluded.count,
+                    sum = sum + excluded.sum,
+                    min = MIN(min, excluded.min),
+                    max = MAX(max, excluded.max),
+                    last = CASE WHEN excluded.last_ts >= last_ts
+                                THEN excluded.last ELSE last END,
+                    last_ts = MAX(last_ts, excluded.last_ts)
+            """, [(*key, *agg) for key, agg in tier.items()])
+        self.buckets = {}
+
+
+def compact(conn, now=None):
+    """Apply each tier's retention policy"""
+    now = time.time() if now is None else now
+    with conn:
+        conn.execute("DELETE FROM device_stats WHERE timestamp < ?",
+                     (now - RAW_RETENTION,))
+        for table, _, retention in TIERS:
+            if retention is not None:
+                conn.execute(f"DELETE FROM {table} WHERE bucket < ?",
+                             (now - retention,))
+    conn.execute("PRAGMA optimize")
+
+
+def pick_tier(start, step, now=None):
+    """Coarsest tier no coarser than step whose retention still covers start.
+
+    Falls back to the finest tier that covers start when step is finer
+    than anything available. Returns None for the raw table.
+    """
+    now = time.time() if now is None else now
+    candidates = [(None, 0, RAW_RETENTION)] + TIERS
+    covering = [tier for tier in candidates
+                if tier[2] is None or now - start <= tier[2]]
+    fitting = [tier for tier in covering if tier[1] <= step]
+    chosen = fitting[-1] if fitting else covering[0]
+    return None if chosen[0] is None else chosen
+
+
+def rollup_series(conn, tier, device_id, start, end, stat='avg'):
+    """{metric: {bucket: value}} from one rollup tier"""
+    table, size, _ = tier
+    value = {'avg': 'sum / count', 'min': 'min', 'max': 'max',
+             'last': 'last'}[stat]
+    rows = conn.execute(f"""
+        SELECT bucket, metric, {value} FROM {table}
+        WHERE device_id = ? AND bucket BETWEEN ? AND ?
+        ORDER BY bucket
+    """, (device_id, start - start % size, end)).fetchall()
+    series = {}
+    for bucket, name, v in rows:
+        series.setdefault(name, {})[bucket] = v
+    return series
+
+
+def to_history(series, resolution, stat):
+    """Pivot {metric: {ts: value}} into the layout of the Node server's
+    /api/device/:id/history, with unix timestamps"""
+    timestamps = sorted({ts for points in series.values() for ts in points})
+
+    def column(name):
+        points = series.get(name, {})
+        return [points.get(ts) for ts in timestamps]
+
+    result = {
+        'resolution': resolution,
+        'stat': stat,
+        'timestamps': timestamps,
+        'cpu': column('cpu'),
+        'memory': column('memory'),
+        'network': {},
+        'disk': {}
+    }
+    for name in series:
+        kind, _, rest = name.partition('.')
+        device, _, field = rest.rpartition('.')
+        if kind == 'net':
+            key = 'rx' if field == 'rx_kb' else 'tx'
+            result['network'].setdefault(device, {})[key] = column(name)
+        elif kind == 'disk':
+            result['disk'].setdefault(device, {})[field] = column(name)
+    return result
@@ -0,0 +1,292 @@
+import json
+import sqlite3
+import time
+
+import rollup
+from timeseries import metric_values
+
+try:
+    # The receiver runs under eventlet; the writer needs a real OS thread
+    # so SQLite I/O never blocks the hub.
+    from eventlet.patcher import original
+    threading = original('threading')
+    queue = original('queue')
+except ImportError:
+    import threading
+    import queue
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS device_stats (
+        device_id TEXT,
+        timestamp INTEGER,
+        cpu_usage_percent REAL,
+        kbmemfree TEXT,
+        kbmemused TEXT,
+        memused_percent TEXT,
+        network_data TEXT,
+        disk_data TEXT,
+        PRIMARY KEY (device_id, timestamp)
+    )
+"""
+
+# Resent samples (the agents deliver at least once) are ignored, so they
+# are neither stored nor folded into the rollups twice
+INSERT = """
+    INSERT OR IGNORE INTO device_stats (
+        device_id, timestamp, cpu_usage_percent,
+        kbmemfree, kbmemused, memused_percent,
+        network_data, disk_data
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+def to_row(data):
+    memory = data.get('memory') or {}
+    return (
+        str(data['id']),
+        data.get('timestamp'),
+        data.get('cpu_usage_percent'),
+        memory.get('kbmemfree'),
+        memory.get('kbmemused'),
+        memory.get('memused_percent'),
+        json.dumps(data.get('network') or [], separators=(',', ':')),
+        json.dumps(data.get('disk') or [], separators=(',', ':'))
+    )
+
+
+def from_row(row):
+    (device_id, timestamp, cpu, memfree, memused, mempercent,
+     network, disk) = row
+    return {
+        "id": device_id,
+        "timestamp": timestamp,
+        "cpu_usage_percent": cpu,
+        "memory": {
+            "kbmemfree": memfree,
+            "kbmemused": memused,
+            "memused_percent": mempercent
+        },
+        "network": json.loads(network) if network else [],
+        "disk": json.loads(disk) if disk else []
+    }
+
+
+class WriteBehindStore:
+    """Persist samples to SQLite off the request path.
+
+    put() only enqueues; a writer thread group-commits whatever has
+    arrived every flush_interval seconds, or sooner once batch_size rows
+    are waiting, with one transaction per batch in WAL mode. The table
+    matches device_stats in the Node server's devices.db. If the queue is
+    full the sample is counted in dropped rather than blocking ingest.
+    close() flushes everything still queued.
+
+    Samples that were new to the raw table, so not resends, are folded
+    into in-memory rollup partials, which are upserted into the 1-minute,
+    1-hour and 1-day tiers every rollup_interval seconds and on close().
+    The tiers therefore lag the raw table by up to rollup_interval, and a
+    crash loses the rollups of that window. Every compact_interval
+    seconds the writer applies each tier's retention policy.
+    """
+
+    def __init__(self, path, flush_interval=0.5, batch_size=5000,
+                 max_queue=200000, compact_interval=300, rollup_interval=60):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.compact_interval = compact_interval
+        self.rollup_interval = rollup_interval
+        self.dropped = 0
+        self.written = 0
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._stop = object()
+        self._partials = rollup.Partials()
+
+        conn = self._connect()
+        conn.execute(SCHEMA)
+        rollup.ensure_schema(conn)
+        conn.commit()
+        conn.close()
+
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='write-behind')
+        self._thread.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def put(self, data):
+        try:
+            self._queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _run(self):
+        conn = self._connect()
+        stopping = False
+        next_compaction = time.monotonic() + self.compact_interval
+        next_rollup = time.monotonic() + self.rollup_interval
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = (self._queue.get(timeout=timeout) if timeout > 0
+                            else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                if item is self._stop:
+                    stopping = True
+                    break
+                batch.append(item)
+            if stopping:
+                # Flush whatever is still queued before exiting
+                while True:
+                    try:
+                        item = self._queue.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is not self._stop:
+                        batch.append(item)
+            if batch:
+                self._write(conn, batch)
+            if self._partials and (stopping
+                                   or time.monotonic() >= next_rollup):
+                next_rollup = time.monotonic() + self.rollup_interval
+                try:
+                    with conn:
+                        self._partials.flush(conn)
+                except sqlite3.Error as e:
+                    print(f"Database error writing rollups: {e}")
+            if time.monotonic() >= next_compaction:
+                next_compaction = time.monotonic() + self.compact_interval
+                try:
+                    rollup.compact(conn)
+                except sqlite3.Error as e:
+                    print(f"Database error during compaction: {e}")
+        conn.close()
+
+    def _write(self, conn, batch):
+        rows = []
+        for data in batch:
+            try:
+                rows.append((to_row(data), data))
+            except (KeyError, TypeError, ValueError) as e:
+                print(f"Skipped unstorable packet: {e}")
+        try:
+            with conn:
+                # Only samples that were new to the raw table go into the
+                # rollups; rowcount is 0 for an ignored duplicate
+                fresh = [data for row, data in rows
+                         if conn.execute(INSERT, row).rowcount]
+            self._partials.add(fresh)
+            self.written += len(fresh)
+        except sqlite3.Error as e:
+            print(f"Database error, dropped {len(rows)} samples: {e}")
+            self.dropped += len(rows)
+
+    def load_latest(self):
+        """Newest packet per device, for restoring state after a restart"""
+        conn = self._connect()
+        try:
+            cursor = conn.execute("""
+                SELECT s.device_id, s.timestamp, s.cpu_usage_percent,
+                       s.kbmemfree, s.kbmemused, s.memused_percent,
+                       s.network_data, s.disk_data
+                FROM device_stats s
+                JOIN (SELECT device_id, MAX(timestamp) AS ts
+                      FROM device_stats GROUP BY device_id) m
+                  ON s.device_id = m.device_id AND s.timestamp = m.ts
+            """)
+            for row in cursor:
+                yield from_row(row)
+        finally:
+            conn.close()
+
+    def load_since(self, since, per_device):
+        """Packets newer than since, at most per_device of the newest for
+        each device, oldest first within a device.
+
+        Rows are streamed from the cursor rather than loaded at once.
+        """
+        conn = self._connect()
+        try:
+            cursor = conn.execute("""
+                SELECT device_id, timestamp, cpu_usage_percent,
+                       kbmemfree, kbmemused, memused_percent,
+                       network_data, disk_data
+                FROM (SELECT *, ROW_NUMBER() OVER (
+                          PARTITION BY device_id ORDER BY timestamp DESC) AS n
+                      FROM device_stats WHERE timestamp >= ?)
+                WHERE n <= ?
+                ORDER BY device_id, timestamp
+            """, (since, per_device))
+            for row in cursor:
+                yield from_row(row)
+        finally:
+            conn.close()
+
+    def load_device(self, device_id, since, limit):
+        """At most limit of one device's newest packets newer than since,
+        oldest first"""
+        conn = self._connect()
+        try:
+            rows = conn.execute("""
+                SELECT * FROM (
+                    SELECT device_id, timestamp, cpu_usage_percent,
+                           kbmemfree, kbmemused, memused_percent,
+                           network_data, disk_data
+                    FROM device_stats
+                    WHERE device_id = ? AND timestamp >= ?
+                    ORDER BY timestamp DESC LIMIT ?)
+                ORDER BY timestamp
+            """, (device_id, since, limit)).fetchall()
+        finally:
+            conn.close()
+        return [from_row(row) for row in rows]
+
+    def close(self):
+        self._queue.put(self._stop)
+        self._thread.join()
+
+    def history(self, device_id, start, end, step=None, stat='avg',
+                max_points=500):
+        """Series for one device from the coarsest tier that fits.
+
+        step is the wanted resolution in seconds and defaults to whatever
+        gives about max_points points. Reads raw rows only when the range
+        is short enough to need them.
+        """
+        if step is None:
+            step = (end - start) / max_points
+        tier = rollup.pick_tier(start, step)
+        conn = self._connect()
+        try:
+            if tier is not None:
+                series = rollup.rollup_series(conn, tier, device_id,
+                                              start, end, stat)
+                return rollup.to_history(series, tier[1], stat)
+            rows = conn.execute("""
+                SELECT device_id, timestamp, cpu_usage_percent,
+                       kbmemfree, kbmemused, memused_percent,
+                       network_data, disk_data
+                FROM device_stats
+                WHERE device_id = ? AND timestamp BETWEEN ? AND ?
+                ORDER BY timestamp
+            """, (device_id, start, end)).fetchall()
+        finally:
+            conn.close()
+        series = {}
+        for row in rows:
+            data = from_row(row)
+            for name, value in metric_values(data):
+                series.setdefault(name, {})[data['timestamp']] = (
+                    None if value != value else value)  # NaN is not JSON
+        return rollup.to_history(series, 0, 'raw')
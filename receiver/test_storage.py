@@ -0,0 +1,59 @@
+import json
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+import rollup
+from storage import WriteBehindStore
+
+
+def packet(timestamp, cpu):
+    return {"id": "dev", "timestamp": timestamp, "cpu_usage_percent": cpu,
+            "memory": {"kbmemfree": "1", "kbmemused": "1",
+                       "memused_percent": "50.00"},
+            "network": [], "disk": []}
+
+
+class WriteBehindStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'devices.db')
+        self.now = int(time.time()) // 60 * 60
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def write(self, *packets):
+        db = WriteBehindStore(self.path, flush_interval=0.01)
+        for data in packets:
+            db.put(data)
+        db.close()
+        return db
+
+    def test_resent_sample_is_not_rolled_up_twice(self):
+        first = packet(self.now, 20.0)
+        self.write(first, dict(first), packet(self.now + 1, 80.0))
+        self.write(dict(first))  # resent in a later batch
+
+        conn = sqlite3.connect(self.path)
+        raw = conn.execute("SELECT COUNT(*), AVG(cpu_usage_percent) "
+                           "FROM device_stats").fetchone()
+        self.assertEqual(raw, (2, 50.0))
+        for table, _, _ in rollup.TIERS:
+            count, total = conn.execute(
+                f"SELECT count, sum FROM {table} WHERE metric = 'cpu'"
+            ).fetchone()
+            self.assertEqual((count, total / count), (2, 50.0), table)
+        conn.close()
+
+    def test_raw_history_is_valid_json(self):
+        db = self.write(packet(self.now, None))
+        history = db.history('dev', self.now - 60, self.now + 60, step=1)
+        self.assertEqual(history['cpu'], [None])
+        json.loads(json.dumps(history, allow_nan=False))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,143 @@
+import math
+from array import array
+from collections import OrderedDict
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty sequence"""
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def metric_values(data):
+    """Flatten a packet into (metric name, value) pairs.
+
+    Names are 'cpu', 'memory', 'net.<iface>.rx_kb', 'net.<iface>.tx_kb',
+    'disk.<device>.wait' and 'disk.<device>.util'.
+    """
+    def number(value):
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return math.nan
+
+    yield 'cpu', number(data.get('cpu_usage_percent'))
+    memory = data.get('memory') or {}
+    yield 'memory', number(memory.get('memused_percent'))
+    for iface in data.get('network') or []:
+        if isinstance(iface, dict) and 'iface' in iface:
+            yield f"net.{iface['iface']}.rx_kb", number(iface.get('rx_kb'))
+            yield f"net.{iface['iface']}.tx_kb", number(iface.get('tx_kb'))
+    for disk in data.get('disk') or []:
+        if isinstance(disk, dict) and 'device' in disk:
+            yield f"disk.{disk['device']}.wait", number(disk.get('wait'))
+            yield f"disk.{disk['device']}.util", number(disk.get('util'))
+
+
+class DeviceSeries:
+    """Fixed-capacity ring of samples for one device.
+
+    Every metric is a preallocated array of doubles sharing one write
+    position with the timestamp column, so row i of every column belongs
+    to the same sample. Gaps (an interface missing from a sample, or a
+    column created after the ring started filling) hold NaN. Memory per
+    device is at most (max_metrics + 1) * capacity * 8 bytes.
+    """
+
+    def __init__(self, capacity, max_metrics=32):
+        self.capacity = capacity
+        self.max_metrics = max_metrics
+        self.timestamps = array('d', [math.nan]) * capacity
+        self.columns = {}
+        self.head = 0  # next slot to write
+        self.count = 0
+
+    def append(self, timestamp, data):
+        slot = self.head
+        self.timestamps[slot] = timestamp
+        for column in self.columns.values():
+            column[slot] = math.nan
+        for name, value in metric_values(data):
+            column = self.columns.get(name)
+            if column is None:
+                if len(self.columns) >= self.max_metrics:
+                    continue
+                column = self.columns[name] = array('d', [math.nan]) * self.capacity
+            column[slot] = value
+        self.head = (slot + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def _slots(self, since=None, until=None):
+        """Slots holding samples in [since, until], oldest first"""
+        slots = []
+        for back in range(1, self.count + 1):
+            slot = (self.head - back) % self.capacity
+            ts = self.timestamps[slot]
+            if since is not None and ts < since:
+                break
+            if until is None or ts <= until:
+                slots.append(slot)
+        slots.reverse()
+        return slots
+
+    def series(self, metric, since=None, until=None):
+        column = self.columns.get(metric)
+        if column is None:
+            return [], []
+        timestamps, values = [], []
+        for slot in self._slots(since, until):
+            value = column[slot]
+            if not math.isnan(value):
+                timestamps.append(self.timestamps[slot])
+                values.append(value)
+        return timestamps, values
+
+    def aggregate(self, metric, since=None, until=None):
+        _, values = self.series(metric, since, until)
+        if not values:
+            return {'count': 0}
+        return {
+            'count': len(values),
+            'mean': sum(values) / len(values),
+            'min': min(values),
+            'max': max(values),
+            'p95': percentile(values, 95)
+        }
+
+
+class TimeSeriesStore:
+    """Per-device ring buffers with a bound on the number of devices.
+
+    The least recently updated device is dropped once max_devices is
+    reached, so total memory stays fixed no matter how many agents report.
+    """
+
+    def __init__(self, capacity=720, max_devices=10000, max_metrics=32):
+        self.capacity = capacity
+        self.max_devices = max_devices
+        self.max_metrics = max_metrics
+        self.devices = OrderedDict()
+
+    def append(self, data):
+        device_id = str(data['id'])
+        try:
+            timestamp = float(data.get('timestamp'))
+        except (TypeError, ValueError):
+            return
+        device = self.devices.get(device_id)
+        if device is None:
+            device = DeviceSeries(self.capacity, self.max_metrics)
+            self.devices[device_id] = device
+            while len(self.devices) > self.max_devices:
+                self.devices.popitem(last=False)
+        else:
+            self.devices.move_to_end(device_id)
+        device.append(timestamp, data)
+
+    def get(self, device_id):
+        return self.devices.get(str(device_id))
+
+    def discard(self, device_id):
+        """Forget a device; True if it was stored"""
+        return self.devices.pop(str(device_id), None) is not None
@@ -1,18 +1,162 @@
 #!/usr/bin/env python3
+import gzip
 import json
 import subprocess
 import re
 import time
 import uuid
 import argparse
+import bisect
+import math
 import sys
 import os
+import random
+import socket
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from datetime import datetime
 import requests
 
 # Configuration file handling - now in same directory
 CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
                            'sysmon_config.json')
+SPOOL_DIR = os.path.join(os.path.dirname(CONFIG_FILE), 'sysmon_spool')
+STATUS_FILE = os.path.join(os.path.dirname(CONFIG_FILE), 'sysmon_status.prom')
+
+COMPACT_CONTENT_TYPE = 'application/x-sysmon-compact'
+# 4xx answers that are worth retrying; any other 4xx rejects a batch for good
+RETRYABLE_CLIENT_ERRORS = (408, 409, 415, 429)
+
+_session = None
+
+
+def get_session():
+    """Shared keep-alive session so sends reuse one pooled connection"""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=2)
+        _session.mount('http://', adapter)
+        _session.mount('https://', adapter)
+    return _session
+
+
+class Metrics:
+    """Counters and latency histograms in Prometheus text format.
+
+    Recording costs a dict update under a lock, so the hot path can be
+    instrumented unconditionally.
+    """
+
+    BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0,
+               2.5, 5.0, 10.0)
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._callbacks = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def callback(self, name, fn, kind='gauge'):
+        """Report fn() under name whenever the metrics are rendered"""
+        self._callbacks[name] = (fn, kind)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = [
+                    [0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            hist[0][bisect.bisect_left(self.BUCKETS, seconds)] += 1
+            hist[1] += seconds
+            hist[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        def fmt(labels):
+            return ('{' + ','.join(f'{k}="{v}"' for k, v in labels) + '}'
+                    if labels else '')
+
+        p = self.prefix
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((k, (list(v[0]), v[1], v[2]))
+                                for k, v in self._histograms.items())
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {p}_{name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, 'counter')
+            lines.append(f"{p}_{name}{fmt(labels)} {value}")
+        for name, (fn, kind) in sorted(self._callbacks.items()):
+            header(name, kind)
+            lines.append(f"{p}_{name} {fn()}")
+        for (name, labels), (buckets, total, count) in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(self.BUCKETS + ('+Inf',), buckets):
+                cumulative += n
+                lines.append(f"{p}_{name}_bucket{fmt(labels + (('le', bound),))}"
+                             f" {cumulative}")
+            lines.append(f"{p}_{name}_sum{fmt(labels)} {total}")
+            lines.append(f"{p}_{name}_count{fmt(labels)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    def write_status(self, path):
+        """Atomically write the current metrics to a local status file"""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port):
+        """Serve /metrics over HTTP from a daemon thread"""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+metrics = Metrics('sysmon_sender')
 
 
 def load_config():
@@ -57,12 +201,14 @@ def get_sysstat(device_id):
         timestamp = int(time.time())
         
         # Collect CPU stats
-        cpu_stats = subprocess.run(['mpstat', '1', '1'], capture_output=True, text=True)
+        with metrics.timer('collector_seconds', collector='cpu'):
+            cpu_stats = subprocess.run(['mpstat', '1', '1'], capture_output=True, text=True)
         cpu_usage_match = re.search(r'(\d+\.\d+)\s*$', cpu_stats.stdout.strip().split("\n")[-1])
         cpu_usage = 100.0 - float(cpu_usage_match.group(1)) if cpu_usage_match else None
         
         # Collect Memory stats
-        mem_stats = subprocess.run(['sar', '-r', '1', '1'], capture_output=True, text=True)
+        with metrics.timer('collector_seconds', collector='memory'):
+            mem_stats = subprocess.run(['sar', '-r', '1', '1'], capture_output=True, text=True)
         mem_lines = mem_stats.stdout.strip().split("\n")
         if len(mem_lines) > 2:
             mem_parts = mem_lines[-1].split()
@@ -76,10 +222,11 @@ def get_sysstat(device_id):
 
         # Collect Disk stats using iostat
         disk_stats = []
-        iostat_result = subprocess.run(['iostat', '-dx', '1', '1'], 
-                                      stdout=subprocess.PIPE, 
-                                      stderr=subprocess.PIPE, 
-                                      text=True)
+        with metrics.timer('collector_seconds', collector='disk'):
+            iostat_result = subprocess.run(['iostat', '-dx', '1', '1'], 
+                                          stdout=subprocess.PIPE, 
+                                          stderr=subprocess.PIPE, 
+                                          text=True)
         for line in iostat_result.stdout.strip().split('\n'):
             if line.startswith('Device'):
                 continue
@@ -96,9 +243,10 @@ def get_sysstat(device_id):
 
         # Collect Network stats using sar
         networks = []
-        sar_result = subprocess.run(['sar', '-n', 'DEV', '1', '1'], 
-                                   capture_output=True, 
-                                   text=True)
+        with metrics.timer('collector_seconds', collector='network'):
+            sar_result = subprocess.run(['sar', '-n', 'DEV', '1', '1'], 
+                                       capture_output=True, 
+                                       text=True)
         for line in sar_result.stdout.strip().split('\n'):
             if any(dev in line for dev in ['eth', 'en', 'wl', 'lo']) and line.startswith("Average"):
                 parts = line.split()
@@ -121,6 +269,276 @@ def get_sysstat(device_id):
         return None
 
 
+class ProcCollector:
+    """Collect system statistics directly from /proc.
+
+    Keeps the previous counters from /proc/stat, /proc/diskstats and
+    /proc/net/dev and reports rates from the deltas between samples, so a
+    sample takes milliseconds instead of forking the sysstat tools.
+    """
+
+    NET_PREFIXES = ('eth', 'en', 'wl', 'lo')
+
+    def __init__(self, warmup=0.25):
+        self.warmup = warmup
+        self._prev = None
+
+    @staticmethod
+    def available():
+        return all(os.access(path, os.R_OK) for path in
+                   ('/proc/stat', '/proc/meminfo',
+                    '/proc/diskstats', '/proc/net/dev'))
+
+    def _read_counters(self):
+        with metrics.timer('collector_seconds', collector='cpu'):
+            cpu = self._read_cpu()
+        with metrics.timer('collector_seconds', collector='disk'):
+            disks = self._read_disks()
+        with metrics.timer('collector_seconds', collector='network'):
+            nets = self._read_nets()
+        return time.monotonic(), cpu, disks, nets
+
+    @staticmethod
+    def _read_cpu():
+        with open('/proc/stat', 'r') as f:
+            return [int(v) for v in f.readline().split()[1:]]
+
+    @staticmethod
+    def _read_disks():
+        disks = {}
+        with open('/proc/diskstats', 'r') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) < 14:
+                    continue
+                name = parts[2]
+                # Whole disks only, like iostat -d without -p
+                if not os.path.exists(f'/sys/block/{name}'):
+                    continue
+                reads, ms_read = int(parts[3]), int(parts[6])
+                writes, ms_write = int(parts[7]), int(parts[10])
+                io_ms = int(parts[12])
+                disks[name] = (reads + writes, ms_read + ms_write, io_ms)
+        return disks
+
+    def _read_nets(self):
+        nets = {}
+        with open('/proc/net/dev', 'r') as f:
+            for line in f.readlines()[2:]:
+                iface, _, counters = line.partition(':')
+                iface = iface.strip()
+                if not iface.startswith(self.NET_PREFIXES):
+                    continue
+                fields = counters.split()
+                nets[iface] = (int(fields[0]), int(fields[8]))
+        return nets
+
+    @staticmethod
+    def _read_memory():
+        meminfo = {}
+        with open('/proc/meminfo', 'r') as f:
+            for line in f:
+                key, _, value = line.partition(':')
+                meminfo[key] = int(value.split()[0])
+        total = meminfo['MemTotal']
+        free = meminfo['MemFree']
+        # Same definition of "used" as sar -r
+        used = (total - free - meminfo.get('Buffers', 0)
+                - meminfo.get('Cached', 0) - meminfo.get('SReclaimable', 0))
+        return {
+            "kbmemfree": str(free),
+            "kbmemused": str(used),
+            "memused_percent": f"{used * 100.0 / total:.2f}"
+        }
+
+    def collect(self, device_id):
+        """Return a payload in the same shape as get_sysstat()"""
+        try:
+            timestamp = int(time.time())
+            if self._prev is None:
+                self._prev = self._read_counters()
+                time.sleep(self.warmup)
+            current = self._read_counters()
+            prev, self._prev = self._prev, current
+            with metrics.timer('collector_seconds', collector='memory'):
+                memory = self._read_memory()
+
+            now, cpu, disks, nets = current
+            then, prev_cpu, prev_disks, prev_nets = prev
+            elapsed = max(now - then, 1e-6)
+
+            # CPU: everything except idle counts as used, as with mpstat
+            deltas = [c - p for c, p in zip(cpu[:8], prev_cpu[:8])]
+            total = sum(deltas)
+            cpu_usage = (100.0 - deltas[3] * 100.0 / total) if total > 0 else 0.0
+
+            disk_stats = []
+            for name, (ios, io_wait_ms, io_ms) in disks.items():
+                if name not in prev_disks:
+                    continue
+                if ios == 0 and io_ms == 0:
+                    continue  # iostat skips devices that never did I/O
+                prev_ios, prev_wait_ms, prev_io_ms = prev_disks[name]
+                d_ios = ios - prev_ios
+                disk_stats.append({
+                    'device': name,
+                    'wait': (io_wait_ms - prev_wait_ms) / d_ios if d_ios > 0 else 0.0,
+                    'util': min(100.0, (io_ms - prev_io_ms) / (elapsed * 10.0))
+                })
+
+            networks = []
+            for iface, (rx, tx) in nets.items():
+                if iface not in prev_nets:
+                    continue
+                prev_rx, prev_tx = prev_nets[iface]
+                networks.append({
+                    'iface': iface,
+                    'rx_kb': f"{(rx - prev_rx) / 1024.0 / elapsed:.2f}",
+                    'tx_kb': f"{(tx - prev_tx) / 1024.0 / elapsed:.2f}"
+                })
+
+            return {
+                "id": device_id,
+                "timestamp": timestamp,
+                "cpu_usage_percent": cpu_usage,
+                "memory": memory,
+                "network": networks,
+                "disk": disk_stats
+            }
+        except Exception as e:
+            print(f"Error collecting system stats: {str(e)}", file=sys.stderr)
+            return None
+
+
+def make_collector(name):
+    """Return a callable device_id -> payload for the chosen collector"""
+    if name == 'proc':
+        if ProcCollector.available():
+            return ProcCollector().collect
+        print("/proc is not readable, falling back to sysstat", file=sys.stderr)
+    return get_sysstat
+
+
+def run_schedule(period):
+    """Yield tick numbers on a drift-free monotonic schedule.
+
+    Deadlines are computed from the start time rather than by sleeping for
+    what is left of each period, so per-iteration jitter never accumulates.
+    Ticks that were missed because an iteration overran are skipped, and
+    the tick number still advances past them.
+    """
+    start = time.monotonic()
+    tick = 0
+    while True:
+        yield tick
+        tick += 1
+        delay = start + tick * period - time.monotonic()
+        if delay < 0:
+            skipped = math.ceil(-delay / period)
+            metrics.inc('schedule_skipped_ticks_total', skipped)
+            tick += skipped
+            delay = start + tick * period - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        metrics.observe('schedule_drift_seconds',
+                        max(0.0, time.monotonic() - (start + tick * period)))
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a non-empty sequence"""
+    ordered = sorted(values)
+    rank = max(0, math.ceil(pct / 100.0 * len(ordered)) - 1)
+    return ordered[rank]
+
+
+def summarize(values):
+    return {
+        "min": min(values),
+        "max": max(values),
+        "mean": sum(values) / len(values),
+        "p95": percentile(values, 95)
+    }
+
+
+class SampleWindow:
+    """Fixed-size in-memory window of fast samples for one reporting interval.
+
+    Each metric keeps its own bounded deque, so memory does not grow with
+    the number of samples taken. summarize() folds the window into a
+    single payload: the usual fields hold the mean over the window and a
+    "window" section carries min/max/mean/p95 for every metric.
+    """
+
+    def __init__(self, size, period):
+        self.size = size
+        self.period = period
+        self.clear()
+
+    def clear(self):
+        self._series = {}
+        self._latest = None
+        self.count = 0
+
+    def _series_for(self, key):
+        if key not in self._series:
+            self._series[key] = deque(maxlen=self.size)
+        return self._series[key]
+
+    def add(self, data):
+        self._latest = data
+        self.count += 1
+        if data.get('cpu_usage_percent') is not None:
+            self._series_for(('cpu_usage_percent',)).append(
+                float(data['cpu_usage_percent']))
+        if 'memused_percent' in data.get('memory', {}):
+            self._series_for(('memused_percent',)).append(
+                float(data['memory']['memused_percent']))
+        for iface in data.get('network', []):
+            for field in ('rx_kb', 'tx_kb'):
+                self._series_for(('network', iface['iface'], field)).append(
+                    float(iface[field]))
+        for disk in data.get('disk', []):
+            for field in ('wait', 'util'):
+                self._series_for(('disk', disk['device'], field)).append(
+                    float(disk[field]))
+
+    def summarize(self):
+        data = dict(self._latest)
+        samples = max(map(len, self._series.values()), default=0)
+        window = {"samples": samples, "period": self.period,
+                  "network": {}, "disk": {}}
+        for key, values in self._series.items():
+            if not values:
+                continue
+            stats = summarize(values)
+            if key[0] == 'network':
+                window['network'].setdefault(key[1], {})[key[2]] = stats
+            elif key[0] == 'disk':
+                window['disk'].setdefault(key[1], {})[key[2]] = stats
+            else:
+                window[key[0]] = stats
+
+        if 'cpu_usage_percent' in window:
+            data['cpu_usage_percent'] = window['cpu_usage_percent']['mean']
+        if 'memused_percent' in window:
+            data['memory'] = dict(data['memory'], memused_percent=
+                                  f"{window['memused_percent']['mean']:.2f}")
+        data['network'] = [
+            dict(iface, **{field: f"{window['network'][iface['iface']][field]['mean']:.2f}"
+                           for field in ('rx_kb', 'tx_kb')})
+            for iface in data.get('network', [])
+            if iface['iface'] in window['network']
+        ]
+        data['disk'] = [
+            dict(disk, **{field: window['disk'][disk['device']][field]['mean']
+                          for field in ('wait', 'util')})
+            for disk in data.get('disk', [])
+            if disk['device'] in window['disk']
+        ]
+        data['window'] = window
+        return data
+
+
 def send_data(server_url, data, verbose=False):
     """Send data to monitoring server"""
     headers = {'Content-Type': 'application/json'}
@@ -129,22 +547,590 @@ def send_data(server_url, data, verbose=False):
             print(f"Sending data to {server_url}...")
             print(json.dumps(data, indent=2))
             
-        response = requests.post(
-            f"{server_url}/data", 
-            json=data, 
-            headers=headers,
-            timeout=5
-        )
+        with metrics.timer('serialize_seconds', encoding='json'):
+            body = json.dumps(data, separators=(',', ':'))
+        with metrics.timer('send_seconds', transport='http'):
+            response = get_session().post(
+                f"{server_url}/data", 
+                data=body, 
+                headers=headers,
+                timeout=5
+            )
         
         if verbose:
             print(f"Server response: {response.status_code} {response.text}")
             
+        if not response.ok:
+            metrics.inc('send_errors_total', transport='http')
         return response.ok
     except requests.exceptions.RequestException as e:
         print(f"Error sending data: {str(e)}", file=sys.stderr)
+        metrics.inc('send_errors_total', transport='http')
         return False
 
 
+class CompactEncoder:
+    """Encode payloads in the compact msgpack wire format.
+
+    Each encoder is one stream with its own random id. A frame is a list:
+
+        [stream, seq, keyframe, device_id, new_names, timestamp,
+         cpu, kbmemfree, kbmemused, memused_percent,
+         [name_idx, rx_kb, tx_kb, ...], [name_idx, wait, util, ...], extra]
+
+    Interface and disk names are sent once and referenced by their index
+    in the stream's dictionary afterwards. On delta frames device_id is
+    nil and timestamp, kbmemfree and kbmemused are differences from the
+    previous frame. Floats are packed as float32. A keyframe is sent
+    every keyframe_interval frames, or after reset().
+    """
+
+    KNOWN_FIELDS = {'id', 'timestamp', 'cpu_usage_percent', 'memory',
+                    'network', 'disk'}
+
+    def __init__(self, keyframe_interval=60):
+        try:
+            import msgpack
+        except ImportError:
+            print("--encoding compact needs the msgpack package",
+                  file=sys.stderr)
+            sys.exit(1)
+        self._msgpack = msgpack
+        self.keyframe_interval = keyframe_interval
+        self.stream = random.getrandbits(31)
+        self.seq = 0
+        self.reset()
+
+    def reset(self):
+        """Start over with a keyframe and an empty name dictionary"""
+        self._names = {}
+        self._prev = None
+
+    def _name_index(self, name, new_names):
+        if name not in self._names:
+            self._names[name] = len(self._names)
+            new_names.append(name)
+        return self._names[name]
+
+    def frame(self, data):
+        if self._prev is not None and self.seq % self.keyframe_interval == 0:
+            self.reset()
+        keyframe = self._prev is None
+
+        memory = data.get('memory') or {}
+        current = (int(data['timestamp']),
+                   int(float(memory.get('kbmemfree', 0))),
+                   int(float(memory.get('kbmemused', 0))))
+        if keyframe:
+            ints = current
+        else:
+            ints = tuple(c - p for c, p in zip(current, self._prev))
+
+        new_names = []
+        network = []
+        for iface in data.get('network', []):
+            network += [self._name_index(iface['iface'], new_names),
+                        float(iface['rx_kb']), float(iface['tx_kb'])]
+        disk = []
+        for d in data.get('disk', []):
+            disk += [self._name_index(d['device'], new_names),
+                     float(d['wait']), float(d['util'])]
+        extra = {k: v for k, v in data.items() if k not in self.KNOWN_FIELDS}
+
+        cpu = data.get('cpu_usage_percent')
+        mem_percent = memory.get('memused_percent')
+        self.seq += 1
+        self._prev = current
+        return [self.stream, self.seq, keyframe,
+                data['id'] if keyframe else None, new_names, ints[0],
+                None if cpu is None else float(cpu), ints[1], ints[2],
+                None if mem_percent is None else float(mem_percent),
+                network, disk, extra or None]
+
+    def pack(self, obj):
+        return self._msgpack.packb(obj, use_single_float=True)
+
+    def encode(self, data):
+        with metrics.timer('serialize_seconds', encoding='compact'):
+            return self.pack(self.frame(data))
+
+
+class RejectedBatch(Exception):
+    """The server refused a batch in a way resending will not fix"""
+
+
+class HttpTransport:
+    """Send samples over HTTP on the shared keep-alive session.
+
+    With encoding='compact' samples go out in the CompactEncoder format.
+    Direct sends and spooled batches each keep one long-lived stream, so
+    batches after the first are delta frames too. A 409 from the server
+    means it lost the stream state, so the sample or batch is resent
+    starting with a keyframe; any other failure also resets the stream.
+    A 415 means it cannot decode the format, and the transport drops back
+    to JSON for good. Bulk bodies are gzipped once they are big enough
+    for it to pay off.
+
+    send_batch() raises RejectedBatch for any other 4xx, and sends a
+    batch the compact format cannot carry as JSON instead.
+    """
+
+    GZIP_MIN_BYTES = 1024
+
+    def __init__(self, server_url, verbose=False, encoding='json'):
+        self.server_url = server_url
+        self.verbose = verbose
+        self.encoder = self.batch_encoder = None
+        if encoding == 'compact':
+            self.encoder = CompactEncoder()
+            self.batch_encoder = CompactEncoder()
+
+    def _post_compact(self, path, body, gzipped=False):
+        headers = {'Content-Type': COMPACT_CONTENT_TYPE}
+        if gzipped:
+            headers['Content-Encoding'] = 'gzip'
+        with metrics.timer('send_seconds', transport='http'):
+            return get_session().post(f"{self.server_url}{path}", data=body,
+                                      headers=headers, timeout=30)
+
+    def _fall_back_to_json(self):
+        print("Server does not accept the compact encoding, using JSON",
+              file=sys.stderr)
+        self.encoder = self.batch_encoder = None
+
+    def send(self, data):
+        if self.encoder is None:
+            return send_data(self.server_url, data, self.verbose)
+        try:
+            response = self._post_compact('/data', self.encoder.encode(data))
+            if response.status_code == 409:
+                self.encoder.reset()
+                response = self._post_compact('/data',
+                                              self.encoder.encode(data))
+            if response.status_code == 415:
+                self._fall_back_to_json()
+                return self.send(data)
+            if self.verbose:
+                print(f"Server response: {response.status_code} {response.text}")
+            if not response.ok:
+                self.encoder.reset()
+            return response.ok
+        except requests.exceptions.RequestException as e:
+            print(f"Error sending data: {str(e)}", file=sys.stderr)
+            self.encoder.reset()
+            return False
+
+    def _post_compact_batch(self, records):
+        encoder = self.batch_encoder
+        with metrics.timer('serialize_seconds', encoding='compact_batch'):
+            body = encoder.pack([encoder.frame(data) for data in records])
+            gzipped = len(body) >= self.GZIP_MIN_BYTES
+            if gzipped:
+                body = gzip.compress(body)
+        return self._post_compact('/data/bulk', body, gzipped)
+
+    def _post_json_batch(self, records):
+        headers = {'Content-Type': 'application/json'}
+        with metrics.timer('serialize_seconds', encoding='json_batch'):
+            body = json.dumps(records, separators=(',', ':')).encode()
+            if len(body) >= self.GZIP_MIN_BYTES:
+                body = gzip.compress(body)
+                headers['Content-Encoding'] = 'gzip'
+        with metrics.timer('send_seconds', transport='http'):
+            return get_session().post(f"{self.server_url}/data/bulk",
+                                      data=body, headers=headers, timeout=30)
+
+    def send_batch(self, records):
+        try:
+            response = None
+            if self.batch_encoder is not None:
+                try:
+                    response = self._post_compact_batch(records)
+                    if response.status_code == 409:
+                        self.batch_encoder.reset()
+                        response = self._post_compact_batch(records)
+                except (AttributeError, KeyError, TypeError, ValueError) as e:
+                    print(f"Sending batch as JSON, it has a sample the "
+                          f"compact encoding cannot carry: {e}",
+                          file=sys.stderr)
+                    self.batch_encoder.reset()
+                if response is not None and response.status_code == 415:
+                    self._fall_back_to_json()
+                    return self.send_batch(records)
+                if response is not None and not response.ok:
+                    self.batch_encoder.reset()
+            if response is None:
+                response = self._post_json_batch(records)
+            if self.verbose:
+                print(f"Uploaded {len(records)} samples: "
+                      f"{response.status_code} {response.text}")
+            if (400 <= response.status_code < 500
+                    and response.status_code not in RETRYABLE_CLIENT_ERRORS):
+                raise RejectedBatch(f"{response.status_code} "
+                                    f"{response.text[:200]}")
+            return response.ok
+        except requests.exceptions.RequestException as e:
+            print(f"Error uploading batch: {str(e)}", file=sys.stderr)
+            if self.batch_encoder is not None:
+                self.batch_encoder.reset()
+            return False
+
+    def close(self):
+        get_session().close()
+
+
+class WebSocketTransport:
+    """Stream samples as JSON messages over one long-lived WebSocket.
+
+    Talks to the Node receiver, which accepts the same JSON as POST /data
+    on its WebSocket. A dropped connection is re-opened on the next send,
+    rate-limited with exponential backoff.
+    """
+
+    def __init__(self, server_url, verbose=False, encoding='json',
+                 backoff_cap=60.0):
+        try:
+            import websocket
+        except ImportError:
+            print("--transport ws needs the websocket-client package",
+                  file=sys.stderr)
+            sys.exit(1)
+        self._websocket = websocket
+        self.url = 'ws' + server_url[len('http'):] \
+            if server_url.startswith('http') else server_url
+        self.verbose = verbose
+        self.backoff_cap = backoff_cap
+        self._conn = None
+        self._attempt = 0
+        self._retry_at = 0.0
+
+    def _connect(self):
+        if self._conn is not None:
+            return True
+        if time.monotonic() < self._retry_at:
+            return False
+        try:
+            self._conn = self._websocket.create_connection(
+                self.url, timeout=5,
+                sockopt=((socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),))
+            self._attempt = 0
+            if self.verbose:
+                print(f"Connected to {self.url}")
+            return True
+        except (OSError, self._websocket.WebSocketException) as e:
+            print(f"Error connecting to {self.url}: {str(e)}", file=sys.stderr)
+            self._retry_at = time.monotonic() + random.uniform(
+                0, min(self.backoff_cap, 2 ** self._attempt))
+            self._attempt += 1
+            return False
+
+    def send(self, data):
+        if not self._connect():
+            return False
+        try:
+            with metrics.timer('serialize_seconds', encoding='json'):
+                message = json.dumps(data, separators=(',', ':'))
+            with metrics.timer('send_seconds', transport='ws'):
+                self._conn.send(message)
+            return True
+        except (OSError, self._websocket.WebSocketException) as e:
+            print(f"Error sending data: {str(e)}", file=sys.stderr)
+            metrics.inc('send_errors_total', transport='ws')
+            self.close()
+            return False
+
+    def send_batch(self, records):
+        for data in records:
+            if not self.send(data):
+                return False
+        return True
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.close()
+            except (OSError, self._websocket.WebSocketException):
+                pass
+            self._conn = None
+
+
+class SocketIOTransport:
+    """Stream samples to receiver.py as json_data Socket.IO events.
+
+    With encoding='compact' each event carries a CompactEncoder frame as
+    binary. Every (re)connect restarts the stream with a keyframe, since
+    the server on the other end may be a restarted receiver or another
+    worker with no state for it; the periodic keyframes cover events lost
+    in between.
+    """
+
+    def __init__(self, server_url, verbose=False, encoding='json'):
+        try:
+            import socketio
+        except ImportError:
+            print("--transport socketio needs the python-socketio package",
+                  file=sys.stderr)
+            sys.exit(1)
+        self.server_url = server_url
+        self.verbose = verbose
+        # The client reconnects on its own once the first connect succeeds
+        self._client = socketio.Client(reconnection=True)
+        self._errors = (socketio.exceptions.SocketIOError, OSError)
+        self.encoder = (CompactEncoder(keyframe_interval=30)
+                        if encoding == 'compact' else None)
+        if self.encoder is not None:
+            self._client.on('connect', self.encoder.reset)
+
+    def send(self, data):
+        try:
+            if not self._client.connected:
+                self._client.connect(self.server_url, transports=['websocket'],
+                                     wait_timeout=5)
+            message = (self.encoder.encode(data) if self.encoder is not None
+                       else data)
+            with metrics.timer('send_seconds', transport='socketio'):
+                self._client.emit('json_data', message)
+            return True
+        except self._errors as e:
+            print(f"Error sending data: {str(e)}", file=sys.stderr)
+            metrics.inc('send_errors_total', transport='socketio')
+            if self.encoder is not None:
+                self.encoder.reset()
+            return False
+
+    def send_batch(self, records):
+        for data in records:
+            if not self.send(data):
+                return False
+        return True
+
+    def close(self):
+        self._client.disconnect()
+
+
+TRANSPORTS = {
+    'http': HttpTransport,
+    'ws': WebSocketTransport,
+    'socketio': SocketIOTransport
+}
+
+
+class Spool:
+    """Bounded on-disk queue of samples waiting to be uploaded.
+
+    Samples are appended as JSON lines to the newest segment file. A
+    segment is sealed once it reaches segment_bytes, and the oldest
+    segments are deleted when the spool grows past max_bytes. The reader
+    consumes segments oldest-first and keeps its position in a cursor file
+    so a restart does not upload the same samples twice.
+    """
+
+    def __init__(self, directory, segment_bytes=1024 * 1024,
+                 max_bytes=64 * 1024 * 1024):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._cursor_file = os.path.join(directory, 'cursor')
+        os.makedirs(directory, exist_ok=True)
+
+        self._segments = sorted(
+            int(name.split('.')[0]) for name in os.listdir(directory)
+            if name.endswith('.seg'))
+        self._next_seq = (self._segments[-1] + 1) if self._segments else 0
+        self._active = None
+        self._read_seq, self._read_offset = self._load_cursor()
+
+    def _path(self, seq):
+        return os.path.join(self.directory, f"{seq:012d}.seg")
+
+    def _load_cursor(self):
+        try:
+            with open(self._cursor_file, 'r') as f:
+                seq, offset = (int(v) for v in f.read().split())
+            if seq in self._segments:
+                return seq, offset
+        except (FileNotFoundError, ValueError):
+            pass
+        return None, 0
+
+    def _save_cursor(self):
+        tmp = self._cursor_file + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(f"{self._read_seq} {self._read_offset}")
+        os.replace(tmp, self._cursor_file)
+
+    def _seal(self):
+        if self._active is not None:
+            self._active.close()
+            self._active = None
+
+    def _size(self):
+        total = 0
+        for seq in self._segments:
+            try:
+                total += os.path.getsize(self._path(seq))
+            except FileNotFoundError:
+                pass
+        return total
+
+    def _evict(self):
+        while len(self._segments) > 1 and self._size() > self.max_bytes:
+            seq = self._segments.pop(0)
+            path = self._path(seq)
+            with open(path, 'rb') as f:
+                self.dropped += sum(1 for _ in f)
+            os.remove(path)
+            if seq == self._read_seq:
+                self._read_seq, self._read_offset = None, 0
+
+    def append(self, data):
+        line = (json.dumps(data, separators=(',', ':')) + '\n').encode()
+        with self._lock:
+            if self._active is None:
+                seq = self._next_seq
+                self._next_seq += 1
+                self._segments.append(seq)
+                self._active = open(self._path(seq), 'ab')
+            self._active.write(line)
+            self._active.flush()
+            if self._active.tell() >= self.segment_bytes:
+                self._seal()
+                self._evict()
+
+    def read_batch(self, max_records):
+        """Return (records, position) for the oldest unsent samples"""
+        with self._lock:
+            if not self._segments:
+                return [], None
+            seq = self._segments[0]
+            if seq != self._read_seq:
+                self._read_seq, self._read_offset = seq, 0
+            if len(self._segments) == 1 and self._active is not None:
+                self._seal()
+
+            records = []
+            with open(self._path(seq), 'rb') as f:
+                f.seek(self._read_offset)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        continue  # torn write from a crash
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        pass
+                    if len(records) >= max_records:
+                        break
+                offset = f.tell()
+                at_end = not f.read(1)
+            return records, (seq, offset, at_end)
+
+    def commit(self, position):
+        """Mark everything up to position as uploaded"""
+        seq, offset, at_end = position
+        with self._lock:
+            if seq not in self._segments:
+                return
+            if at_end:
+                self._segments.remove(seq)
+                os.remove(self._path(seq))
+                self._read_seq, self._read_offset = None, 0
+                try:
+                    os.remove(self._cursor_file)
+                except FileNotFoundError:
+                    pass
+            else:
+                self._read_seq, self._read_offset = seq, offset
+                self._save_cursor()
+
+    def close(self):
+        with self._lock:
+            self._seal()
+
+
+class Uploader(threading.Thread):
+    """Background thread that drains a Spool through a transport.
+
+    Over HTTP, batches go to the bulk ingest endpoint as gzip-compressed
+    JSON arrays. Failed uploads are retried with exponential backoff and
+    full jitter, so a fleet of agents does not hammer a recovering server
+    in lockstep.
+
+    Delivery is at-least-once: a batch is retried whole, so samples that
+    landed before a failure (a bulk response lost in transit, or the
+    first events of a WebSocket/Socket.IO batch that broke partway) are
+    sent again. Receivers key samples on (device id, timestamp), which
+    makes the resends harmless. A batch the server rejects outright (a
+    4xx other than 408/409/415/429) is logged, counted as dropped and
+    skipped so it cannot block the spool.
+    """
+
+    def __init__(self, transport, spool, batch_size=500, backoff_base=1.0,
+                 backoff_cap=300.0):
+        super().__init__(daemon=True)
+        self.transport = transport
+        self.spool = spool
+        self.batch_size = batch_size
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+        self.wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._idle = threading.Event()
+
+    def run(self):
+        attempt = 0
+        while not self._stopping.is_set():
+            try:
+                uploaded = self._upload_next()
+            except Exception as e:  # keep draining whatever went wrong
+                print(f"Uploader error: {e!r}", file=sys.stderr)
+                uploaded = False
+            if uploaded:
+                attempt = 0
+                continue
+
+            metrics.inc('upload_retries_total')
+            delay = random.uniform(
+                0, min(self.backoff_cap, self.backoff_base * 2 ** attempt))
+            attempt += 1
+            self._stopping.wait(delay)
+
+    def _upload_next(self):
+        """Upload the next batch; False if it should be retried later"""
+        records, position = self.spool.read_batch(self.batch_size)
+        if not records:
+            if position is not None:
+                self.spool.commit(position)
+                return True
+            self._idle.set()
+            self.wakeup.wait(1.0)
+            self.wakeup.clear()
+            return True
+        self._idle.clear()
+
+        try:
+            if not self.transport.send_batch(records):
+                return False
+        except RejectedBatch as e:
+            print(f"Dropped {len(records)} spooled samples the server "
+                  f"rejected: {e}", file=sys.stderr)
+            metrics.inc('dropped_samples_total', len(records))
+        else:
+            metrics.inc('uploaded_samples_total', len(records))
+        self.spool.commit(position)
+        return True
+
+    def stop(self, drain_timeout=10.0):
+        """Give the spool a chance to drain, then stop the thread"""
+        self._idle.clear()
+        self.wakeup.set()
+        self._idle.wait(drain_timeout)
+        self._stopping.set()
+        self.wakeup.set()
+        self.join(timeout=5)
+
+
 def main():
     # Load initial config from file
     initial_config = load_config()
@@ -187,6 +1173,45 @@ def main():
         action='store_true',
         help='Send data once and exit'
     )
+    parser.add_argument(
+        '--collector',
+        choices=['proc', 'sysstat'],
+        default='proc',
+        help='Read stats from /proc directly or run the sysstat tools'
+    )
+    parser.add_argument(
+        '--sample-interval',
+        type=float,
+        help='Sample every N seconds and send min/max/mean/p95 once per '
+             'interval (omit to send a single sample per interval)'
+    )
+    parser.add_argument(
+        '--no-spool',
+        action='store_true',
+        help='Send each sample directly instead of spooling to disk and '
+             'uploading in batches'
+    )
+    parser.add_argument(
+        '--transport',
+        choices=sorted(TRANSPORTS),
+        default='http',
+        help='http: keep-alive POSTs, ws: stream over a WebSocket to the '
+             'Node receiver, socketio: stream json_data events to receiver.py'
+    )
+    parser.add_argument(
+        '--encoding',
+        choices=['json', 'compact'],
+        default='json',
+        help='Wire format; compact is typed msgpack with delta encoding '
+             '(receiver.py only)'
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        default=0,
+        help='Serve the agent\'s own metrics on this port at /metrics '
+             '(0 disables; they are also written to sysmon_status.prom)'
+    )
     parser.add_argument(
         '--new-id',
         action='store_true',
@@ -224,39 +1249,87 @@ def main():
     if args.once:
         args.count = 1
 
+    if args.sample_interval is not None:
+        if args.sample_interval <= 0:
+            parser.error('--sample-interval must be positive')
+        if args.sample_interval >= config['interval']:
+            parser.error('--sample-interval must be shorter than the interval')
+        if args.collector == 'sysstat':
+            parser.error('--sample-interval needs the proc collector')
+
+    collect = make_collector(args.collector)
+
+    if args.sample_interval:
+        period = args.sample_interval
+        samples_per_report = max(1, round(config['interval'] / period))
+        window = SampleWindow(samples_per_report, period)
+    else:
+        period = config['interval']
+        samples_per_report = 1
+        window = None
+
+    if args.encoding == 'compact' and args.transport == 'ws':
+        parser.error('the Node receiver only accepts JSON over --transport ws')
+
+    transport = TRANSPORTS[args.transport](config['server'], config['verbose'],
+                                           args.encoding)
+    spool = uploader = None
+    if not args.dry_run and not args.no_spool:
+        spool = Spool(SPOOL_DIR)
+        uploader = Uploader(transport, spool)
+        uploader.start()
+        metrics.callback('spool_dropped_samples_total',
+                         lambda: spool.dropped, 'counter')
+    if args.metrics_port:
+        metrics.serve(args.metrics_port)
+
     try:
         sent_count = 0
-        while True:
-            start_time = time.time()
-            
-            data = get_sysstat(config['device_id'])
+        next_report = samples_per_report - 1
+        for tick in run_schedule(period):
+            data = collect(config['device_id'])
+            if data is not None and window is not None:
+                window.add(data)
+                data = None
+            if tick < next_report:
+                continue
+            next_report = tick + samples_per_report
+            if window is not None and window.count:
+                data = window.summarize()
+                window.clear()
             if data is None:
-                time.sleep(config['interval'])
+                metrics.inc('collect_errors_total')
                 continue
-                
-            if not args.dry_run:
-                success = send_data(config['server'], data, config['verbose'])
+
+            if spool is not None:
+                spool.append(data)
+                uploader.wakeup.set()
+            elif not args.dry_run:
+                success = transport.send(data)
                 if not success:
-                    time.sleep(config['interval'])
+                    metrics.inc('dropped_samples_total')
+                    metrics.write_status(STATUS_FILE)
                     continue
             
             sent_count += 1
+            metrics.inc('reports_total')
+            metrics.write_status(STATUS_FILE)
             if config['verbose']:
                 print(f"[{datetime.now().isoformat()}] Sent {sent_count} packets")
             
             if 0 < args.count <= sent_count:
                 break
-                
-            # Sleep for remaining interval time
-            elapsed = time.time() - start_time
-            sleep_time = max(0, config['interval'] - elapsed)
-            time.sleep(sleep_time)
             
     except KeyboardInterrupt:
         print("\nMonitoring stopped by user")
     except Exception as e:
         print(f"Fatal error: {str(e)}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        if uploader is not None:
+            uploader.stop()
+            spool.close()
+        transport.close()
 
 
 if __name__ == "__main__":